@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" Benchmark of command dispatch in tex2htm
+
+    Runs process_recursively() over a document made of many short commands,
+    half of them unknown (as in a book full of custom macros), and reports
+    the time, the memory allocated and the blocks left allocated per
+    command, as well as how much the handler tables grew.
+
+    Usage: ./benchmark.py [number of commands]
+"""
+import sys
+import time
+import tracemalloc
+
+import tex2htm
+
+
+def make_context():
+    ctx = tex2htm.context()
+    tex2htm.setup_environment_handlers(ctx)
+    tex2htm.setup_command_handlers(ctx)
+    ctx.outputfile = 'benchmark.html'
+    ctx.chapter = 0
+    return ctx
+
+def make_document(n):
+    """ n commands, half of them unknown ones from a few hundred macros """
+    return "".join([r'\emph{{a}} \macro{} '.format(i % 500)
+                    for i in range(n//2)])
+
+def run(n):
+    tex = make_document(n)
+    ctx = make_context()
+    handlers = len(ctx.command_handlers) + len(ctx.environment_handlers)
+
+    start = time.perf_counter()
+    tex2htm.process_recursively(ctx, tex, 0)
+    elapsed = time.perf_counter() - start
+
+    ctx = make_context()
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    html = tex2htm.process_recursively(ctx, tex, 0)
+    retained = sys.getallocatedblocks() - blocks
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del html
+
+    growth = len(ctx.command_handlers) + len(ctx.environment_handlers) \
+             - handlers
+    print("{} commands".format(n))
+    print("{:.2f} us per command".format(1e6*elapsed/n))
+    print("{:.0f} bytes allocated (peak) per command".format(peak/n))
+    print("{:.2f} blocks retained per command".format(retained/n))
+    print("{} entries added to the handler tables".format(growth))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -1,39 +1,71 @@
-""" Open Data Structures specific extension for tex2htm """
+""" Open Data Structures specific extension for tex2htm
+
+    Load this with tex2htm.py --plugin ods
+"""
 import os
 import sys
 import re
 
-from pygments import highlight
-from pygments.lexers import JavaLexer
-from pygments.formatters import HtmlFormatter
-
-
 from catlist import catlist
 import tex2htm
 
 
-# This is for doing inline code formatting
-class CodeHtmlFormatter(HtmlFormatter):
-
-    def __init__(self):
-        super(CodeHtmlFormatter, self).__init__()
-        self.lineseparator = ''
-
-    def wrap(self, source, outfile):
-        return self._wrap_code(source)
-
-    def _wrap_code(self, source):
-        yield 0, '<code class="highlight">'
-        for i, t in source:
-            # if i == 1:
-            #     # it's a line of formatted code
-            #     t += '<br>'
-            yield i, t
-        yield 0, '</code>'
+def setup(ctx):
+    """ Register this extension's handlers and filters with ctx """
+    setup_environment_handlers(ctx)
+    setup_command_handlers(ctx)
+    ctx.early_filters.append(preprocess_hashes)
+    ctx.late_filters.append(convert_hashes)
+
+# Pygments (and its Java lexer) takes a while to import, so we only do
+# that when we first have some code to highlight
+_highlighter = dict()
+
+def highlight_java(ctx, code, inline=False):
+    """ Highlight Java code as a block or, if inline, as a <code> element """
+    if ctx.check_mode:
+        # Nothing is rendered when checking
+        return ''
+    if not _highlighter:
+        pygments = tex2htm.timed_import(ctx, 'pygments')
+        lexers = tex2htm.timed_import(ctx, 'pygments.lexers.jvm')
+        formatters = tex2htm.timed_import(ctx, 'pygments.formatters')
+
+        # This is for doing inline code formatting
+        class CodeHtmlFormatter(formatters.HtmlFormatter):
+
+            def __init__(self):
+                super(CodeHtmlFormatter, self).__init__()
+                self.lineseparator = ''
+
+            def wrap(self, source, outfile=None):
+                return self._wrap_code(source)
+
+            def _wrap_code(self, source):
+                yield 0, '<code class="highlight">'
+                for i, t in source:
+                    # if i == 1:
+                    #     # it's a line of formatted code
+                    #     t += '<br>'
+                    yield i, t
+                yield 0, '</code>'
+
+        _highlighter['highlight'] = pygments.highlight
+        _highlighter['lexer'] = lexers.JavaLexer()
+        _highlighter['block'] = formatters.HtmlFormatter()
+        _highlighter['inline'] = CodeHtmlFormatter()
+    formatter = _highlighter['inline' if inline else 'block']
+    return _highlighter['highlight'](code, _highlighter['lexer'], formatter)
 
 # This is a regular expression I've debugged for doing hash substitutions
 hash_rx = re.compile(r'(^|#|[^\\])#(([^#]|\\#)*[^\\#])#', re.M|re.S)
 
+# The same thing, with the ^ matching at the position we start looking
+hash_at_rx = re.compile(r'()#(([^#]|\\#)*[^\\#])#', re.M|re.S)
+
+def find_hash(tex, pos):
+    """ Search for hash_rx in tex[pos:], without making a copy of tex[pos:] """
+    return hash_at_rx.match(tex, pos) or hash_rx.search(tex, pos)
 
 # NOTE: Looks more complicated than necessary, but actually had to
 #       be written this way to work around a problem with adjacent matches
@@ -41,17 +73,17 @@ hash_rx = re.compile(r'(^|#|[^\\])#(([^#]|\\#)*[^\\#])#', re.M|re.S)
 def preprocess_hashes(tex):
     """Prevents percents inside hashes from being treated as comments"""
     blocks = catlist()
-    rx = hash_rx
-    m = rx.search(tex)
+    pos = 0
+    m = find_hash(tex, pos)
     while m:
         if len(m.group(2)) > 40:
             tex2htm.warn("Possible runaway hash: {}".format(text_sample(m.group(2))))
             raise(None)
-        blocks.append(tex[:m.start()])
+        blocks.append(tex[pos:m.start()])
         blocks.append(re.sub(r'(^|[^\\])%', r'\1\%', m.group(0)))
-        tex = tex[m.end():]
-        m = rx.search(tex)
-    blocks.append(tex)
+        pos = m.end()
+        m = find_hash(tex, pos)
+    blocks.append(tex[pos:])
     return "".join(blocks)
 
 # NOTE: Looks more complicated than necessary, but actually had to
@@ -59,17 +91,17 @@ def preprocess_hashes(tex):
 #       Try the string r'\[#x##y#\bmod m\]'
 def convert_hashes(tex):
     blocks = catlist()
-    rx = hash_rx
-    m = rx.search(tex)
+    pos = 0
+    m = find_hash(tex, pos)
     while m:
         if len(m.group(2)) > 40:
             tex2htm.warn("Possible runaway hash: {}".format(text_sample(m.group(2))))
-        blocks.append(tex[:m.start()])
+        blocks.append(tex[pos:m.start()])
         blocks.append('{}\\begin{{hash}}{}\\end{{hash}}'.format(m.group(1),
                         m.group(2)))
-        tex = tex[m.end():]
-        m = rx.search(tex)
-    blocks.append(tex)
+        pos = m.end()
+        m = find_hash(tex, pos)
+    blocks.append(tex[pos:])
     return "".join(blocks)
 
 def setup_command_handlers(ctx):
@@ -85,24 +117,29 @@ def setup_command_handlers(ctx):
     for c in strip:
         ctx.command_handlers[c] = tex2htm.process_cmd_strip
 
-def get_member(member, clz):
-    basedir = os.path.dirname(sys.argv[1]) + os.path.sep + ".." + \
+java_type = r'\w+(?:<.*>)?(?:\[\])*'
+java_keywords = '(?:static|public|protected|private|final)'
+java_keywords_rx = re.compile(java_keywords + r'\s+')
+java_throws_rx = re.compile(r'\sthrows\s[^{]+')
+java_method_rx = re.compile(r'\s*(?:<[^>]*>\s+)?(?:{type}\s+)?(\w+)\s*\((.*)\)\s*{{\s*$'.format(type=java_type))
+java_instancevar_rx = re.compile(r'\s*(?:{type})\s+(\w+)\s*(?:=.*)?;'.format(type=java_type))
+java_class_rx = re.compile(r'^\s*(?:{}\s+)*class\s+((?:\w|[<>])+)'.format(java_keywords))
+
+def get_member(ctx, member, clz):
+    basedir = ctx.inputdir + os.path.sep + ".." + \
                   os.path.sep + 'java'
     filename = basedir+os.path.sep+clz+'.java' # FIXME: hard-coded
+    tex2htm.record_dependency(ctx, filename)
     code = catlist()
     d = 0
     writing = False
     found = False
-    typeregex = r'\w+(?:<.*>)?(?:\[\])*'
-    keywords = '(?:static|public|protected|private|final)'
-    methodregex = r'\s*(?:<[^>]*>\s+)?(?:{type}\s+)?(\w+)\s*\((.*)\)\s*{{\s*$'.format(type=typeregex)
-    instancevarregex = r'\s*(?:{type})\s+(\w+)\s*(?:=.*)?;'.format(type=typeregex)
     for line in open(filename).read().splitlines():
-        line = re.sub('{}\s+'.format(keywords), '', line)
-        line = re.sub('\t', '    ', line)
-        line = re.sub(r'\sthrows\s[^{]+', '', line)
+        line = java_keywords_rx.sub('', line)
+        line = line.replace('\t', '    ')
+        line = java_throws_rx.sub('', line)
         if d == 1:
-            m = re.match(methodregex, line)
+            m = java_method_rx.match(line)
             if m:
                 # this line is a method definition
                 name = m.group(1)
@@ -113,14 +150,14 @@ def get_member(member, clz):
                     found = True
                     writing = True
             #m = re.match('\s*(<[^>]*>)?\s*(?:\w+(?:<.*>)?(?:\[\])?)\s*(\w+)\s*;\s*$', line)
-            m = re.match(instancevarregex, line)
+            m = java_instancevar_rx.match(line)
             if m:
                 # this is an instance variable declaration
                 name = m.group(1)
                 if name == member:
                     found = True
                     code.append(line)
-            m = re.match(r'^\s*(?:{}\s+)*class\s+((?:\w|[<>])+)'.format(keywords), line)
+            m = java_class_rx.match(line)
             if m:
                 # This is an internal class definition
                 name = m.group(1)
@@ -131,8 +168,8 @@ def get_member(member, clz):
         d += line.count('{')
         d -= line.count('}')
         if writing:
-            if (not re.search('IndexOutOfBoundsException', line)) \
-               and (not re.search('@SuppressWarnings', line)):
+            if 'IndexOutOfBoundsException' not in line \
+               and '@SuppressWarnings' not in line:
                 code.append(line)
             if d <= 1:
                 writing = False
@@ -149,8 +186,10 @@ def process_codeimport_cmd(ctx, tex, cmd, mode):
     members = members.split('.')
     code = catlist()
     for member in members:
-        code.extend(get_member(member, clz))
-    blocks.append(highlight("\n".join(code), JavaLexer(), HtmlFormatter()))
+        code.extend(get_member(ctx, member, clz))
+    code = "\n".join(code)
+    blocks.append(tex2htm.share_listing(ctx, highlight_java(ctx, code),
+                                        code.count("\n") + 1))
     blocks.append("</div><!-- codeimport -->")
     return blocks
 
@@ -167,11 +206,8 @@ def process_hash_env(ctx, b, env, mode):
             return catlist([r'\texttt{{{}}}'.format(inner)])
         return catlist([r'<span class="texttt">{}</span>'.format(inner)])
 
-    print(mode, env)
-
     inner = re.sub(r'(^|[^\\])&', r'\1\&', env.content)
-    # return catlist([highlight(inner, JavaLexer(), CodeHtmlFormatter())])
     if mode & tex2htm.MATH:
         return catlist([r'\texttt{{{}}}'.format(inner)])
     else:
-        return catlist([highlight(inner, JavaLexer(), CodeHtmlFormatter())])
+        return catlist([highlight_java(ctx, inner, inline=True)])
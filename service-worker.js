@@ -0,0 +1,79 @@
+// Service worker for books converted with tex2htm.py --offline
+//
+// tex2htm writes this file next to the pages as sw.js, with VERSION
+// replaced by a digest of precache-manifest.json, so browsers install a
+// new worker whenever a file of the book changes. The worker then fetches
+// only the files whose revision in the manifest changed, and serves the
+// book from its cache from then on.
+var VERSION = 'VERSION';
+var CACHE = 'tex2htm-precache';
+var MANIFEST = 'precache-manifest.json';
+
+function absolute(url) {
+  return new URL(url, self.registration.scope).href;
+}
+
+function update() {
+  return caches.open(CACHE).then(function (cache) {
+    return Promise.all([
+      fetch(MANIFEST, {cache: 'no-cache'}).then(function (r) {
+        return r.json();
+      }),
+      cache.match(absolute(MANIFEST)).then(function (r) {
+        return r ? r.json() : {files: {}};
+      })
+    ]).then(function (manifests) {
+      var files = manifests[0].files;
+      var old = manifests[1].files;
+      var changed = Object.keys(files).filter(function (url) {
+        return old[url] !== files[url];
+      });
+      var removed = Object.keys(old).filter(function (url) {
+        return !(url in files);
+      });
+      return Promise.all(changed.map(function (url) {
+        return fetch(url, {cache: 'no-cache'}).then(function (r) {
+          if (!r.ok) {
+            throw new Error('Cannot precache ' + url);
+          }
+          return cache.put(absolute(url), r);
+        });
+      }).concat(removed.map(function (url) {
+        return cache.delete(absolute(url));
+      }))).then(function () {
+        // Recorded last, so an interrupted update is resumed next time
+        return cache.put(absolute(MANIFEST),
+                         new Response(JSON.stringify(manifests[0])));
+      });
+    });
+  });
+}
+
+self.addEventListener('install', function (event) {
+  event.waitUntil(update().then(function () {
+    return self.skipWaiting();
+  }));
+});
+
+self.addEventListener('activate', function (event) {
+  event.waitUntil(self.clients.claim());
+});
+
+self.addEventListener('fetch', function (event) {
+  var request = event.request;
+  if (request.method !== 'GET'
+      || !request.url.startsWith(self.registration.scope)) {
+    return;
+  }
+  var url = new URL(request.url);
+  url.hash = '';
+  url.search = '';
+  if (url.pathname.endsWith('/')) {
+    url.pathname += 'index.html';
+  }
+  event.respondWith(caches.open(CACHE).then(function (cache) {
+    return cache.match(url.href);
+  }).then(function (response) {
+    return response || fetch(request);
+  }));
+});
@@ -0,0 +1,103 @@
+""" Regression tests for tex2htm.py --changed
+
+    Run with python -m unittest discover tests (or pytest).
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+tex2htm = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tex2htm.py')
+
+
+class ChangedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir, name), 'w') as fp:
+            fp.write(text)
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name)) as fp:
+            return fp.read()
+
+    def build(self, *args, **kwargs):
+        files = [os.path.join(self.dir, f)
+                 for f in kwargs.get('files', ['a.tex', 'b.tex'])]
+        result = subprocess.run([sys.executable, tex2htm] + list(args)
+                                + files, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def footnotes(self, name):
+        return re.findall(r'<sup>(\d+)</sup>', self.read(name))
+
+    def test_footnotes_of_earlier_chapter(self):
+        """ Footnote numbers run across chapters, so a chapter after one
+            that gained a footnote is stale
+        """
+        self.write('a.tex', '\\chapter{A}\nOne\\footnote{first}.\n')
+        self.write('b.tex', '\\chapter{B}\nTwo\\footnote{second}.\n')
+        self.build()
+        self.assertEqual(self.footnotes('b.html'), ['2'])
+
+        self.write('a.tex', '\\chapter{A}\nOne\\footnote{first}.\n'
+                            'More\\footnote{another}.\n')
+        output = self.build('--changed')
+        self.assertNotIn('Up to date: {}'.format(
+            os.path.join(self.dir, 'b.tex')), output)
+        self.assertEqual(self.footnotes('b.html'), ['3'])
+
+        changed = self.read('b.html')
+        self.build()
+        self.assertEqual(self.read('b.html'), changed)
+
+    def test_new_citation(self):
+        """ A chapter that starts citing an entry changes the entries that
+            the bibliography renders, so the bibliography is stale
+        """
+        files = ['a.tex', 'b.tex', 'refs.bbl']
+        self.write('a.tex', '\\chapter{A}\nNothing cited.\n')
+        self.write('b.tex', '\\chapter{B}\nSee~\\cite{knuth}.\n')
+        self.write('refs.bbl', '\\begin{thebibliography}{2}\n'
+                   '\\bibitem{cormen}\nCormen.\n\n'
+                   '\\bibitem{knuth}\nKnuth.\n\n'
+                   '\\end{thebibliography}\n')
+        self.build(files=files)
+        self.assertNotIn('Cormen', self.read('refs.html'))
+
+        self.write('a.tex', '\\chapter{A}\nSee~\\cite{cormen}.\n')
+        output = self.build('--changed', files=files)
+        self.assertNotIn('Up to date: {}'.format(
+            os.path.join(self.dir, 'refs.bbl')), output)
+        self.assertIn('Cormen', self.read('refs.html'))
+        self.assertNotIn('REFERR', self.read('a.html'))
+
+        changed = [self.read(f) for f in ['a.html', 'b.html', 'refs.html']]
+        self.build(files=files)
+        self.assertEqual([self.read(f)
+                          for f in ['a.html', 'b.html', 'refs.html']], changed)
+
+    def test_unchanged_chapters_are_skipped(self):
+        self.write('a.tex', '\\chapter{A}\nOne\\footnote{first}.\n')
+        self.write('b.tex', '\\chapter{B}\nTwo\\footnote{second}.\n')
+        self.build()
+        output = self.build('--changed')
+        for f in ['a.tex', 'b.tex']:
+            self.assertIn('Up to date: {}'.format(
+                os.path.join(self.dir, f)), output)
+        self.assertEqual(self.footnotes('b.html'), ['2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+""" Scaling checks for the hot paths of tex2htm
+
+    Each check generates pathological inputs of growing size (or nesting
+    depth), times one stage on them and fits the growth rate t ~ n^k by
+    least squares on a log-log scale. A check fails if k is clearly worse
+    than its bound, so accidentally quadratic code gets caught.
+
+    Run with python -m unittest discover tests (or pytest).
+"""
+import os
+import sys
+import math
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tex2htm
+import ods
+
+
+# Near-linear, with room for timing noise
+LINEAR = 1.3
+
+# Nested structures are re-scanned once per level of nesting, so their
+# cost is O(depth * size). This bound catches anything worse than that.
+NESTED = 2.3
+
+def make_context():
+    ctx = tex2htm.context()
+    tex2htm.setup_environment_handlers(ctx)
+    tex2htm.setup_command_handlers(ctx)
+    ctx.outputfile = 'scaling.html'
+    ctx.chapter = 0
+    return ctx
+
+def process(tex):
+    return tex2htm.process_recursively(make_context(), tex, 0)
+
+def preprocess(tex):
+    return tex2htm.preprocess(make_context(), tex, 0)
+
+# Each check is (name, stage, input generator, sizes, bound)
+checks = [
+    ('match_parens: long argument', process,
+     lambda n: r'\emph{' + 'word '*n + '}',
+     [5000, 10000, 20000, 40000], LINEAR),
+    ('match_parens: many arguments', process,
+     lambda n: r'a \href{x}{y} '*n,
+     [500, 1000, 2000, 4000], LINEAR),
+    ('get_environment: many environments', process,
+     lambda n: r'\begin{center}x\end{center} '*n,
+     [500, 1000, 2000, 4000], LINEAR),
+    ('process_recursively: many nested blocks', process,
+     lambda n: (r'\emph{\begin{center}'*4 + 'x' + r'\end{center}}'*4)*n,
+     [100, 200, 400, 800], LINEAR),
+    ('process_recursively: nesting depth', process,
+     lambda n: r'\emph{'*n + 'x' + '}'*n,
+     [25, 50, 100, 200], NESTED),
+    ('get_environment: nesting depth', process,
+     lambda n: r'\begin{center}'*n + 'x' + r'\end{center}'*n,
+     [25, 50, 100, 200], NESTED),
+    ('process_tabular_env: many rows', process,
+     lambda n: r'\begin{tabular}{|l|c|}' + r'a & \emph{b} \t2hlinebreak '*n
+               + r'\end{tabular}',
+     [500, 1000, 2000, 4000], LINEAR),
+    ('process_items: many items', process,
+     lambda n: r'\begin{itemize}' + r'\item[-] a \emph{b} '*n
+               + r'\end{itemize}',
+     [500, 1000, 2000, 4000], LINEAR),
+    ('process_items: nested lists', process,
+     lambda n: (r'\begin{enumerate}\item a \begin{itemize}\item b'
+                r'\item c\end{itemize}\item d\end{enumerate} ')*n,
+     [200, 400, 800, 1600], LINEAR),
+    ('preprocess_hashes: many hashes', ods.preprocess_hashes,
+     lambda n: 'a #x# '*n,
+     [4000, 8000, 16000, 32000], LINEAR),
+    ('convert_hashes: many hashes', ods.convert_hashes,
+     lambda n: 'a #x# '*n,
+     [4000, 8000, 16000, 32000], LINEAR),
+    ('tex2htm: many dollars', preprocess,
+     lambda n: r'a $x$ b \$ '*n,
+     [1000, 2000, 4000, 8000], LINEAR),
+    ('tex2htm: unmatched dollar', preprocess,
+     lambda n: r'$ ' + r'a \$ b '*n,
+     [1000, 2000, 4000, 8000], LINEAR),
+]
+
+def measure(stage, tex, repeats=5):
+    """ The best of several timings of stage(tex) """
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        stage(tex)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def growth_rate(sizes, times):
+    """ The slope of the least-squares line through (log n, log t) """
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(t) for t in times]
+    mx = sum(xs)/len(xs)
+    my = sum(ys)/len(ys)
+    num = sum([(x-mx)*(y-my) for x, y in zip(xs, ys)])
+    den = sum([(x-mx)**2 for x in xs])
+    return num/den
+
+class ScalingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recursionlimit = sys.getrecursionlimit()
+        sys.setrecursionlimit(10000)
+
+    def tearDown(self):
+        sys.setrecursionlimit(self.recursionlimit)
+
+    def test_growth_rates(self):
+        for (name, stage, generate, sizes, bound) in checks:
+            with self.subTest(name):
+                times = [measure(stage, generate(n)) for n in sizes]
+                k = growth_rate(sizes, times)
+                self.assertLessEqual(k, bound, "{}: n^{:.2f}".format(name, k))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,4 +13,4 @@ if __name__ == "__main__":
     basedir = '/home/morin/remote/public_html/ods/newhtml/ods/latex2'
     texfiles = [basedir + os.path.sep + f for f in texfiles]
 
-    subprocess.call(['./tex2htm.py'] + texfiles)
+    subprocess.call(['./tex2htm.py', '--plugin', 'ods'] + texfiles)
@@ -5,7 +5,22 @@
 import os
 import sys
 import re
+import copy
+import math
+import json
+import time
+import zlib
+import pickle
+import hashlib
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import tempfile
+import contextlib
+import tracemalloc
 import subprocess
+import unicodedata
 from collections import defaultdict
 
 from catlist import catlist
@@ -19,12 +34,24 @@ from catlist import catlist
 # Low priority
 # TODO: Support for \verb
 
-import ods
+class handler_table(dict):
+    """ Maps command or environment names to their handlers
+
+        Names without a handler get the default handler. Unlike with a
+        defaultdict, looking them up doesn't add them to the table, so it
+        doesn't grow with every unknown macro in a document.
+    """
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+
+    def __missing__(self, name):
+        return self.default
 
 class context(object):
     def __init__(self):
-        self.environment_handlers = defaultdict(lambda: process_env_default)
-        self.command_handlers = defaultdict(lambda: process_cmd_default)
+        self.environment_handlers = handler_table(process_env_default)
+        self.command_handlers = handler_table(process_cmd_default)
 
         # Environments that are theorem-like or that have captions should be here
         self.named_entities = {'chap': 'Chapter',
@@ -49,9 +76,44 @@ class context(object):
         self.undefined_labels = set()
         self.unprocessed_commands = set()
         self.unprocessed_environments = set()
+        self.unhandled_accents = set()
+        # Pages with undefined labels
+        self.unresolved_pages = set()
 
         # Graphics files to generate after processing is done
         self.graphics_files = set()
+        # Optimized figures, see optimized_figure(). Figures further into
+        # a page than fold_chars load lazily, and smaller than
+        # inline_figure_bytes go inline
+        self.figure_cache = dict()
+        self.fold_chars = 4000
+        self.inline_figure_bytes = 2048
+        # Figure files that pages load, for the precache manifest
+        self.figure_files = set()
+        # Highlighted code listings longer than inline_listing_lines are
+        # written once to shared files, see share_listing()
+        self.share_listings = False
+        self.inline_listing_lines = 10
+        self.listings = dict()
+
+        # Keys of bibliography entries that are cited somewhere, and the
+        # source files that cite them
+        self.cited_keys = set()
+        self.citing_sources = set()
+
+        # Files read while converting the current chapter, and the source
+        # file of each page, see record_dependency()
+        self.dependencies = set()
+        self.sources = dict()
+
+        # Math environments and commands used on the current page, and on
+        # all pages, see record_math_features()
+        self.math_features = set()
+        self.book_math_features = set()
+
+        # Used for generating element ids, see gen_unique_id()
+        self.id_ordinals = defaultdict(int)
+        self.used_ids = set()
 
         # Used for processing footnotes
         self.footnote_counter = 0
@@ -59,9 +121,47 @@ class context(object):
         # Document title
         self.title = 'Untitled'
 
-        # Table of contents
-        self.global_toc = catlist()
-        self.toc = catlist()
+        # Number of processes used to convert the sections of a chapter
+        self.jobs = 1
+
+        # Extension modules, see load_plugin()
+        self.plugins = []
+        # Functions applied to the text before and after the generic
+        # preprocessing done by tex2htm()
+        self.early_filters = []
+        self.late_filters = []
+        # How long it took to import modules, see timed_import()
+        self.import_times = dict()
+        # Records the stages of the build, and their memory use, see stage()
+        self.tracer = None
+        self.memory = None
+
+        # Where to keep preprocessed documents, see preprocess_cached()
+        self.cachedir = None
+        self.parse_cache = None
+        self.version = None
+
+        # Output variants, see make_variant()
+        self.variants = dict()
+        self.variant = 'standard'
+        self.suffix = ''
+        self.skeleton_filters = []
+
+        # Render for screen readers rather than for the eye
+        self.screenreader_mode = False
+        # Only look for problems, without rendering, see check_files()
+        self.check_mode = False
+
+        # Table of contents, as (depth, html) entries, see add_toc_entry()
+        self.global_toc = []
+        self.toc = []
+
+        # Links between pages, for the hints added by link_hints(), and
+        # the scripts and stylesheets each page uses
+        self.page_links = dict()
+        self.page_assets = dict()
+        self.asset_counts = defaultdict(int)
+        self.max_link_hints = 5
 
 MATH = 1  # Mode for processing math environments
 MATHBREAK = 1<<1  # A break from mathmode line \mbox or \text
@@ -72,6 +172,11 @@ TABULAR = 1<<2 # Mode for processing tabular environments
 crossref_format = 'CROSSREF〈{}|{}|{}〉'
 crossref_rx = re.compile(r'CROSSREF〈((\w|:|-)+)\|((?:\w|:|-)+)\|([^〉]*)〉')
 
+# and figures that are finished once their files exist look like this
+# FIGURE〈filename〉
+figure_format = 'FIGURE〈{}〉'
+figure_rx = re.compile(r'FIGURE〈([^〉]*)〉')
+
 #
 # Utilities
 #
@@ -82,36 +187,222 @@ def abort(msg, status=-1):
 def warn(msg, level=0):
     sys.stderr.write("Warning: {}\n".format(msg))
 
+def timed_import(ctx, name):
+    """ Import the module name, recording how long it took in ctx """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    ctx.import_times[name] = time.perf_counter() - start
+    return module
+
+def load_plugin(ctx, name):
+    """ Load the extension module name and let it register itself with ctx
+
+        An extension module has a setup(ctx) function that installs its
+        handlers and filters. Heavy dependencies of an extension should be
+        imported when they are first used rather than at import time.
+    """
+    module = timed_import(ctx, name)
+    module.setup(ctx)
+    ctx.plugins.append(module)
+    return module
+
+class tracer(object):
+    """ Records the stages of a build as Chrome trace events
+
+        The result can be loaded into chrome://tracing or Perfetto to see
+        the build on a timeline, with a row for each process.
+    """
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.events = []
+
+    def fork(self):
+        """ A tracer for a worker process, on the same clock as this one """
+        return tracer(self.origin)
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(),
+                                'tid': os.getpid(),
+                                'ts': 1e6*(start - self.origin),
+                                'dur': 1e6*(time.perf_counter() - start),
+                                'args': args})
+
+    def write(self, filename):
+        """ Write the trace to filename, with a span for the whole build """
+        pids = sorted(set([e['pid'] for e in self.events]))
+        names = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid,
+                  'args': {'name': 'tex2htm' if pid == os.getpid()
+                                   else 'worker {}'.format(pid)}}
+                 for pid in pids]
+        build = {'name': 'build', 'ph': 'X', 'pid': os.getpid(),
+                 'tid': os.getpid(), 'ts': 0,
+                 'dur': 1e6*(time.perf_counter() - self.origin), 'args': {}}
+        with open(filename, 'w') as fp:
+            json.dump({'traceEvents': names + [build] + self.events,
+                       'displayTimeUnit': 'ms'}, fp)
+
+class memory_meter(object):
+    """ Measures the memory that the stages of a build allocate, with
+        tracemalloc
+
+        For each stage we record its peak (the most memory allocated at
+        any time during the stage, over what was allocated when it
+        started) and what it retained (how much more memory is allocated
+        after the stage than before). So a stage is not charged for what
+        the stages before it left allocated. A stage whose peak goes over
+        budget bytes aborts the build.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.records = []
+        # For each stage we are in: [memory at the start, peak so far]
+        self.stack = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def fork(self):
+        """ A meter for a worker process, which leaves the budget to us """
+        return memory_meter()
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.stack.append([current, current])
+        try:
+            yield
+        except BaseException:
+            # Like an abort() from an inner stage
+            self.stack.pop()
+            raise
+        current, peak = tracemalloc.get_traced_memory()
+        (start, peak_so_far) = self.stack.pop()
+        peak = max(peak, peak_so_far)
+        self.add([(name, args, peak - start, current - start)])
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        tracemalloc.reset_peak()
+
+    def add(self, records):
+        """ Add the (name, args, peak, retained) records of some stages """
+        self.records.extend(records)
+        for (name, args, peak, retained) in records:
+            if self.budget and peak > self.budget:
+                where = ", ".join(["{}={}".format(k, v)
+                                   for (k, v) in sorted(args.items())])
+                abort("Memory budget of {} exceeded in stage {}{}: peak {}"
+                      .format(format_size(self.budget), name,
+                              " ({})".format(where) if where else "",
+                              format_size(peak)))
+
+    def report(self):
+        """ Print the peak and retained memory by stage and by chapter """
+        stages = dict()
+        for (name, args, peak, retained) in self.records:
+            (p, r) = stages.get(name, (0, 0))
+            stages[name] = (max(p, peak), r + retained)
+        print("{:30} {:>10} {:>10}".format('Stage', 'Peak', 'Retained'))
+        for name in stages:
+            (peak, retained) = stages[name]
+            print("{:30} {:>10} {:>10}".format(name, format_size(peak),
+                                               format_size(retained)))
+        for (name, args, peak, retained) in self.records:
+            if name == 'chapter':
+                print("{:30} {:>10} {:>10}".format(
+                    "{} ({})".format(os.path.basename(args['file']),
+                                     args['variant']),
+                    format_size(peak), format_size(retained)))
+
+def parse_size(s):
+    """ The number of bytes in a size like 512M, for --max-memory """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*$', s)
+    if not m:
+        raise argparse.ArgumentTypeError("Not a size: {}".format(s))
+    scale = {'': 1, 'k': 1<<10, 'm': 1<<20, 'g': 1<<30}
+    return int(float(m.group(1)) * scale[m.group(2).lower()])
+
+def format_size(n):
+    """ n bytes, in the largest unit that keeps n above 1 """
+    if abs(n) < 1024:
+        return "{} B".format(n)
+    for unit in ['KB', 'MB', 'GB']:
+        n /= 1024
+        if abs(n) < 1024 or unit == 'GB':
+            return "{:.1f} {}".format(n, unit)
+
+def stage(ctx, name, **args):
+    """ A context manager for a stage of the build, which is traced if
+        ctx.tracer is set and measured if ctx.memory is set
+    """
+    probes = [p for p in [ctx.memory, ctx.tracer] if p is not None]
+    if not probes:
+        return contextlib.nullcontext()
+    if len(probes) == 1:
+        return probes[0].span(name, args)
+    return nested_spans(probes, name, args)
+
+@contextlib.contextmanager
+def nested_spans(probes, name, args):
+    with contextlib.ExitStack() as stack:
+        for p in probes:
+            stack.enter_context(p.span(name, args))
+        yield
+
 def skip_space(tex, i):
     while i < len(tex) and tex[i].isspace():
         i += 1
     return i
 
+# How each kind of parenthesis changes the nesting depth, see match_parens()
+paren_depths = dict()
+
 def match_parens(tex, i, open, close):
     # TODO: Handle escape sequences
-    di = defaultdict(int, {open: 1, close: -1})
+    di = paren_depths.get((open, close))
+    if di is None:
+        di = paren_depths[(open, close)] = {open: 1, close: -1}
     j0 = skip_space(tex, i)
     if j0 == len(tex): return i,i+1
     j = j0
     try:
-        d = di[tex[j]]
+        d = di.get(tex[j], 0)
         if d == 0: return i,i+1
         j = j+d
         while d > 0:
-            d += di[tex[j]]
+            d += di.get(tex[j], 0)
             j+=1
         return j0,j
     except IndexError:
         abort("Couldn't match parenthesis:\n... "
               + tex[max(0,i):min(len(tex),i+25)])
 
-id_counter = 0
-def gen_unique_id(prefix=''):
-    global id_counter
-    id_counter += 1
+def gen_unique_id(ctx, scope, prefix=''):
+    """ Generate an id for an element of ctx.outputfile
+
+        The id depends only on scope (a section number like 2.3) and on the
+        number of ids already generated in that scope, so editing one
+        section or chapter does not renumber the ids anywhere else.
+    """
     if not prefix:
         prefix = 'tex2htm'
-    return '{}-{}'.format(prefix, id_counter)
+    key = (ctx.outputfile, scope)
+    ctx.id_ordinals[key] += 1
+    idd = '{}-{}-{}'.format(prefix, scope.replace('.', '-'),
+                            ctx.id_ordinals[key])
+    if (ctx.outputfile, idd) in ctx.used_ids:
+        warn("Duplicate id {} in {}".format(idd, ctx.outputfile))
+        idd = gen_unique_id(ctx, scope, prefix)
+    ctx.used_ids.add((ctx.outputfile, idd))
+    return idd
 
 def text_sample(txt):
     if len(txt) < 50:
@@ -141,19 +432,41 @@ def split_paragraphs(tex):
             lines[i] += '<p>'
     return "\n".join(lines)
 
-def add_toc_entry(ctx, text, label, name):
-    # d = text.count('.')
-    # if len(ctx.toc) > 0:
-    #     last = ctx.toc[-1]
-    #     print(last, text)
-    #     d_last = last.count('.')
-    #     if d > d_last:
-    #         ctx.toc.append("<ul>")
-    #     elif d < d_last:
-    #         ctx.toc.append("</ul>")
-    ctx.toc.append('<li>')
-    ctx.toc.append(crossref_format.format(label, name, text))
-    ctx.toc.append('</li>')
+def add_toc_entry(ctx, text, label, name, depth):
+    """ Add a link to label to the table of contents, depth levels down """
+    ctx.toc.append((depth, crossref_format.format(label, name, text)))
+
+def toc_html(entries):
+    """ The nested lists for the (depth, html) entries of a table of contents """
+    blocks = ['<ul class="toc">']
+    depth = 0
+    first = True
+    for (d, html) in entries:
+        # Skipped levels would make lists without items
+        d = min(d, depth + 1)
+        if d > depth:
+            blocks.append('<ul>')
+        elif not first:
+            blocks.append('</li>')
+            blocks.extend(['</ul></li>']*(depth - d))
+        blocks.append('<li>{}'.format(html))
+        depth = d
+        first = False
+    if not first:
+        blocks.append('</li>')
+        blocks.extend(['</ul></li>']*depth)
+    blocks.append('</ul>')
+    return "".join(blocks)
+
+def toc_loader(ctx, filename, indexfile, tocfile):
+    """ A link from filename to the table of contents in indexfile that
+        loads the shared fragment tocfile in its place, if it can
+    """
+    return '<a class="tocloader" href="{}" data-src="{}">Show</a>'.format(
+        relative_path(variant_filename(ctx, filename),
+                      variant_filename(ctx, indexfile)),
+        relative_path(variant_filename(ctx, filename),
+                      variant_filename(ctx, tocfile)))
 
 #
 # Label and Reference Handling
@@ -161,25 +474,51 @@ def add_toc_entry(ctx, text, label, name):
 #       and captions is super hacky. Consider using JavaScript to do this,
 #       like here: https://github.com/rauschma/html_demos
 #
-def process_labels(ctx, tex, chapter):
-    """ Process all the labels that occur in tex
+class label_counters(object):
+    """ The numbering state of process_labels()
 
-        This works by scanning for commands and environments that alter
-        numbering as well as any LaTeX labelling commands.
+        Streaming mode keeps one of these from one piece of a document to
+        the next, so numbering continues where the last piece stopped.
     """
     headings = ['chapter'] + ['sub'*i + 'section' for i in range(4)]
-    reh = r'(' + '|'.join(headings) + r'){(.+?)}'
     environments = ['thm', 'lem', 'exc', 'figure', 'equation']
-    ree = r'begin{(' + '|'.join(environments) + r')}'
+
+    def __init__(self, chapter):
+        self.sec_ctr = [chapter] + [0]*(len(self.headings))
+        self.env_ctr = [0]*len(self.environments)
+        self.lastlabel = None
+        self.lastenv = None
+        self.scope = '{}.0'.format(chapter)  # anything before the first \chapter
+
+def make_label_rx():
+    """ The regex for the commands that process_labels() looks at """
+    reh = r'(' + '|'.join(label_counters.headings) + r'){(.+?)}'
+    ree = r'begin{(' + '|'.join(label_counters.environments) + r')}'
     rel = r'(\w+)label{(.+?)}'
     rel2 = r'label{(.+?)}'
     bigone = r'\\({})|\\({})|\\({})|\\(caption)|\\({})'.format(reh, ree, rel, rel2)
-    rx = re.compile(bigone)
+    return re.compile(bigone)
+
+label_rx = make_label_rx()
+
+def process_labels(ctx, tex, chapter, counters=None):
+    """ Process all the labels that occur in tex
 
-    sec_ctr = [chapter] + [0]*(len(headings))
-    env_ctr = [0]*len(environments)
+        This works by scanning for commands and environments that alter
+        numbering as well as any LaTeX labelling commands.
+    """
+    headings = label_counters.headings
+    environments = label_counters.environments
+    rx = label_rx
+
+    if counters is None:
+        counters = label_counters(chapter)
+    sec_ctr = counters.sec_ctr
+    env_ctr = counters.env_ctr
     blocks = catlist()
-    lastlabel = None
+    lastlabel = counters.lastlabel
+    lastenv = counters.lastenv
+    scope = counters.scope
     lastidx = 0
     m = rx.search(tex, lastidx)
     while m:
@@ -192,15 +531,17 @@ def process_labels(ctx, tex, chapter):
             name = m.group(2)
             i = headings.index(name)
             if i == 0:
-                env_ctr = [0]*len(env_ctr)
+                env_ctr[:] = [0]*len(env_ctr)
             sec_ctr[i:] = [sec_ctr[i]+1]+[0]*(len(headings)-i-1)
             number = ".".join([str(x) for x in sec_ctr[:i+1]])
             idd = "{}:{}".format(name, number)
             lastlabel = idd
+            scope = number
             blocks.append("<a id='{}'></a>".format(idd))
 
+            # The optional argument carries the number to gen_unique_id()
             title = '{}&emsp;{}'.format(number, cmd.args[0])
-            blocks.append(r'\{}{{{}}}'.format(name, title))
+            blocks.append(r'\{}[{}]{{{}}}'.format(name, number, title))
 
         elif m.group(5):
             # This is an environment (thm, lem, ...)
@@ -239,12 +580,15 @@ def process_labels(ctx, tex, chapter):
 
         elif m.group(10):
             # This is a \label command, probably the target of a pageref
-            idd = gen_unique_id()
+            idd = gen_unique_id(ctx, scope)
             blocks.append("<a id={}></a>".format(idd))
             ctx.label_map[m.group(11)] = (ctx.outputfile, idd)
 
         m = rx.search(tex, lastidx)
     blocks.append(tex[lastidx:])
+    counters.lastlabel = lastlabel
+    counters.lastenv = lastenv
+    counters.scope = scope
     return "".join(blocks)
 
 
@@ -286,13 +630,15 @@ def chomp_args(tex, pos):
     return (optargs, args, pos, j)
 
 
+command_rx = re.compile(r'\\([a-zA-Z0-9]+\*?)')
+
 def next_command(tex, pos):
     """Get the next command in tex that occurs at or after pos"""
-    rx = re.compile(r'\\([a-zA-Z0-9]+\*?)')
-    m = rx.search(tex, pos)
+    m = command_rx.search(tex, pos)
     if m:
         optargs, args, t, j = chomp_args(tex, m.end())
-        cmd = command(m.group(1), optargs, args, m.start(), j)
+        # Interned names are shared, and quick to look up in handler tables
+        cmd = command(sys.intern(m.group(1)), optargs, args, m.start(), j)
         return cmd
     return None
 
@@ -323,11 +669,12 @@ def setup_command_handlers(ctx):
     ctx.command_handlers['tnote'] = process_tnote_cmd
     ctx.command_handlers['cent'] = process_cent_cmd
     ctx.command_handlers['t2hlinebreak'] = process_t2hlinebreak_cmd
+    ctx.command_handlers['multicolumn'] = process_multicolumn_cmd
 
     worthless = ['newlength', 'setlength', 'addtolength', 'vspace', 'index',
                  'cpponly', 'cppimport', 'pcodeonly', 'pcodeimport', 'qedhere',
                  'end', 'hline', 'noindent', 'pagenumbering', 'linewidth',
-                 'newcommand', 'resizebox', 'setcounter', 'multicolumn']
+                 'newcommand', 'resizebox', 'setcounter']
     for c in worthless:
         ctx.command_handlers[c] = process_cmd_worthless
 
@@ -380,7 +727,7 @@ def process_mathbreaker_cmd(ctx, text, cmd, mode):
 
 def process_t2hlinebreak_cmd(ctx, tex, cmd, mode):
     blocks = catlist()
-    if mode & (MATH | TABULAR):
+    if mode & MATH:
         blocks.append('\\\\')
         if cmd.optargs:
             blocks.append('[{}]'.format(cmd.optargs[0]))
@@ -390,43 +737,54 @@ def process_t2hlinebreak_cmd(ctx, tex, cmd, mode):
 def process_path_cmd(ctx, tex, cmd, mode):
     return catlist(['<span class="path">{}</span>'.format(cmd.args[0])])
 
+dots = {'ldots': '&hellip;',
+        'vdots': '&#x22ee;'}
+
 def process_dots_cmd(ctx, tex, cmd, mode):
     """ Various kinds of ellipses """
     if mode & MATH:
         return process_cmd_default(ctx, tex, cmd, mode)
     else:
-        mapper = { 'ldots': '&hellip;',
-                'vdots': '&#x22ee;' }
-        if cmd.name in mapper:
-            return catlist([mapper[cmd.name]])
+        if cmd.name in dots:
+            return catlist([dots[cmd.name]])
     warn("Unrecognized non-math dots: {}".format(cmd.name))
     return catlist([ '?' ])
 
+def heading_scope(ctx, cmd):
+    """ The section number that process_labels() gave to a heading """
+    if cmd.optargs:
+        return cmd.optargs[0]
+    return '{}.0'.format(ctx.chapter)
+
 def process_chapter_cmd(ctx, text, cmd, mode):
     ctx.title = cmd.args[0]
     blocks = catlist()
-    ident = gen_unique_id()
+    ident = gen_unique_id(ctx, heading_scope(ctx, cmd))
     blocks.append('<div id="{}" class="chapter">'.format(ident))
     htmlblocks = process_recursively(ctx, cmd.args[0], mode)
-    add_toc_entry(ctx, ''.join(htmlblocks), ident, 'chap')
+    add_toc_entry(ctx, ''.join(htmlblocks), ident, 'chap', 0)
     ctx.label_map[ident] = (ctx.outputfile, ident)
     blocks.extend(htmlblocks)
     blocks.append('</div><!-- chapter -->')
     return blocks
 
 def process_section_cmd(ctx, text, cmd, mode):
-    ident = gen_unique_id()
+    ident = gen_unique_id(ctx, heading_scope(ctx, cmd))
     blocks = catlist(['<h1 id="{}">'.format(ident)])
     htmlblocks = process_recursively(ctx, cmd.args[0], mode)
-    add_toc_entry(ctx, ''.join(htmlblocks), ident, 'sec')
+    add_toc_entry(ctx, ''.join(htmlblocks), ident, 'sec', 1)
     ctx.label_map[ident] = (ctx.outputfile, ident)
     blocks.extend(htmlblocks)
     blocks.append("</h1>")
     return blocks
 
 def process_subsection_cmd(ctx, text, cmd, mode):
-    blocks = catlist(["<h2>"])
-    blocks.extend(process_recursively(ctx, cmd.args[0], mode))
+    ident = gen_unique_id(ctx, heading_scope(ctx, cmd))
+    blocks = catlist(['<h2 id="{}">'.format(ident)])
+    htmlblocks = process_recursively(ctx, cmd.args[0], mode)
+    add_toc_entry(ctx, ''.join(htmlblocks), ident, 'sec', 2)
+    ctx.label_map[ident] = (ctx.outputfile, ident)
+    blocks.extend(htmlblocks)
     blocks.append("</h2>")
     return blocks
 
@@ -463,7 +821,8 @@ def process_enspace_cmd(ctx, text, cmd, mode):
 def process_graphics_cmd(ctx, text, cmd, mode):
     filename = "{}.svg".format(cmd.args[0])
     ctx.graphics_files.add(filename)
-    return catlist(['<span class="imgwrap"><img class="includegraphics" src="{}"/></span>'.format(filename)])
+    return catlist(['<span class="imgwrap">{}</span>'.format(
+        figure_format.format(filename))])
 
 def process_centering_cmd(ctx, text, cmd, mode):
     blocks = catlist(['<div class="centering">'])
@@ -504,8 +863,10 @@ def crossref_text(ctx, name, texlabel, default=''):
     return "{}&nbsp;{}".format(name, num)
 
 
+ref_rx = re.compile(r'^(.*)ref')
+
 def process_ref_cmd(ctx, tex, cmd, mode):
-    name = re.sub(r'^(.*)ref', r'\1', cmd.name).lower()
+    name = ref_rx.sub(r'\1', cmd.name).lower()
     if name:
         texlabel = "{}:{}".format(name, cmd.args[0])
     else:
@@ -520,7 +881,7 @@ def process_sref_cmd(ctx, tex, cmd, mode):
     return process_ref_cmd(ctx, tex, cmd, mode)
 
 def process_pageref_cmd(ctx, tex, cmd, mode):
-    name = re.sub(r'^(.*)ref', r'\1', cmd.name).lower()
+    name = ref_rx.sub(r'\1', cmd.name).lower()
     texlabel = cmd.args[0]
     text = crossref_text(ctx, name, texlabel)
     html = crossref_format.format(texlabel, name, text)
@@ -529,6 +890,7 @@ def process_pageref_cmd(ctx, tex, cmd, mode):
 def process_cite_cmd(ctx, tex, cmd, mode):
     blocks = catlist(['['])
     args = [s.strip() for s in cmd.args[0].split(',')]
+    ctx.cited_keys.update(args)
     htmls = [crossref_format.format("cite:{}".format(a), 'cite', '') \
                 for a in args]
     blocks.append(",".join(htmls))
@@ -585,6 +947,9 @@ def setup_environment_handlers(ctx):
     ctx.environment_handlers['center'] = process_center_env
     ctx.environment_handlers['thebibliography'] = process_thebibliography_env
 
+# The regexes for the \\begin and \\end of each environment, by name
+environment_rxs = dict()
+
 def get_environment(tex, begincmd):
     """ Get an environment that is started by begincmd.
 
@@ -600,18 +965,21 @@ def get_environment(tex, begincmd):
     optargs, args, t, pos0 = chomp_args(tex, pos)
     pos = pos0
     d = 1
-    regex = r'\\(begin|end){{{}}}'.format(re.escape(name))
-    rx = re.compile(regex)
+    rx = environment_rxs.get(name)
+    if rx is None:
+        regex = r'\\(begin|end){{{}}}'.format(re.escape(name))
+        rx = environment_rxs[name] = re.compile(regex)
     while d > 0:
         m = rx.search(tex, pos)
         if not m:
-            abort("Unmatched environment:". format(name))
+            abort("Unmatched environment: {}".format(name))
         if m.group(1) == 'begin':
             d += 1
         else:
             d -= 1
         pos = m.end()
-    return environment(name, optargs, args,
+    # Arguments right after \begin{name} were taken by begincmd
+    return environment(name, optargs, begincmd.args[1:] + args,
                        tex[pos0:m.start()], begincmd.start, m.end())
 
 def process_env_passthru(ctx, b, env, mode):
@@ -621,84 +989,273 @@ def process_env_passthru(ctx, b, env, mode):
     return blocks
 
 def process_displaymath_env(ctx, b, env, mode):
+    record_math_features(ctx, env)
     return process_env_passthru(ctx, b, env, mode | MATH)
 
 def process_inlinemath_env(ctx, b, env, mode):
+    record_math_features(ctx, env)
     blocks = catlist([r'\('])
     blocks.extend(process_recursively(ctx, env.content, mode | MATH))
     blocks.append(r'\)')
     return blocks
 
 def process_thebibliography_env(ctx, b, env, mode):
-    env.content = re.sub('{thebibliography}', '{enumerate}', env.content)
-    blocks = catlist()
+    """ Render the entries of a bibliography that have been cited
+
+        Entries are numbered in the order of the bibliography. If nothing
+        has been cited (for instance because the bibliography comes first)
+        then every entry is rendered.
+    """
+    entries = parse_thebibliography(ctx, env.content)
+    cited = ctx.cited_keys or set([key for (key, body) in entries])
+    for filename in ctx.citing_sources:
+        record_dependency(ctx, filename)
+    blocks = catlist(['<ol class="{}">'.format(env.name)])
     ref = 1
-    i = 0
-    rx = re.compile(r'\\bibitem\s*{(\w+)}')
-    for m in rx.finditer(env.content):
-        blocks.append(env.content[i:m.start()])
-        i = m.end()
-        texlabel = "cite:{}".format(m.group(1))
+    for (key, body) in entries:
+        if key not in cited:
+            continue
         htmllabel = 'cite:{}'.format(ref)
         ref += 1
-        ctx.label_map[texlabel] = (ctx.outputfile, htmllabel)
-        blocks.append(r'<a id="{}"</a>'.format(htmllabel))
-        blocks.append(r'\item')
-    blocks.append(env.content[i:])
-    env.content = "".join(blocks)
-    # env.content = re.sub(r'\\bibitem\s*{(\w+)}', r'\item', env.content)
-    blocks = process_list_env(ctx, b, env, mode)
-    txt = "".join([b for b in blocks])
-    # bibtex-generated bibliographies are full of superfluous braces
-    txt = re.sub(r'{([^}]*)}', r'\1', txt)
-    return catlist([txt])
+        ctx.label_map["cite:{}".format(key)] = (ctx.outputfile, htmllabel)
+        html = "".join(process_recursively(ctx, body, mode))
+        # bibtex-generated bibliographies are full of superfluous braces
+        html = re.sub(r'{([^}]*)}', r'\1', html)
+        blocks.append('<li><a id="{}"></a>{}</li>'.format(htmllabel, html))
+    blocks.append('</ol>')
+    return blocks
 
-def process_list_env(ctx, b, env, mode):
-    newblocks = catlist()
-    mapper = dict([('itemize', 'ul'), ('enumerate', 'ol'), ('list', 'ul'),
-                   ('thebibliography', 'ol')])
-    tag = mapper[env.name]
-    newblocks.append('<{} class="{}">'.format(tag, env.name))
-    newblocks.extend(process_recursively(ctx, process_list_items(env.content), mode))
-    newblocks.append('</li></{}>'.format(tag))
-    return newblocks
+list_tags = {'itemize': 'ul', 'enumerate': 'ol', 'list': 'ul',
+             'thebibliography': 'ol'}
+
+# The tokens that structure the body of a list environment
+list_token_rx = re.compile(r'\\(?:begin|end|item)(?![a-zA-Z])|\\.|[{}]')
+
+def list_items(tex):
+    """ Split the body of a list environment into its items
 
-def process_list_items(b):
-    b = re.sub(r'\\item((\[)|\s+)', '\1\\2', b, 1)
-    b = re.sub(r'\\item((\[)|\s+)', '\2\1\\2', b)
-    b = re.sub(r'\s*' + '\1' + r'\s*', '<li>', b, 0, re.M|re.S)
-    b = re.sub(r'\s*' + '\2' + r'\s*', '</li>', b, 0, re.M|re.S)
-    return b
+        Only the top-level \\item commands start items; the ones inside
+        groups and nested lists are left for those lists. The result is
+        the text before the first item, and a list of (label, body) pairs,
+        where label is the optional argument of \\item (or None).
+    """
+    items = []
+    label = None
+    preamble = None
+    depth = 0
+    start = 0
+    for m in list_token_rx.finditer(tex):
+        token = m.group(0)
+        if token == '{' or token == r'\begin':
+            depth += 1
+        elif token == '}' or token == r'\end':
+            depth -= 1
+        elif token == r'\item' and depth == 0:
+            if preamble is None:
+                preamble = tex[start:m.start()]
+            else:
+                items.append((label, tex[start:m.start()]))
+            label = None
+            start = m.end()
+            i = start
+            while i < len(tex) and tex[i].isspace():
+                i += 1
+            if i < len(tex) and tex[i] == '[':
+                j, k = match_parens(tex, i, '[', ']')
+                label = tex[j+1:k-1]
+                start = k
+    if preamble is None:
+        return tex, items
+    items.append((label, tex[start:]))
+    return preamble, items
+
+def process_list_env(ctx, b, env, mode):
+    tag = list_tags[env.name]
+    return process_items(ctx, env, tag, process_list_label, mode)
+
+def process_list_label(ctx, label, mode):
+    """ An item label replaces the bullet or number of a list item """
+    blocks = catlist(['<li class="labeled"><span class="itemlabel">'])
+    blocks.extend(process_recursively(ctx, label, mode))
+    blocks.append('</span>')
+    return blocks
 
 def process_description_env(ctx, b, env, mode):
-    newblocks = catlist()
-    newblocks.append('<ul class="{}">'.format(env.name))
-    newblocks.extend(process_recursively(ctx, process_description_items(env.content), mode))
-    newblocks.append('</li></ul>')
+    return process_items(ctx, env, 'ul', process_description_label, mode)
+
+def process_description_label(ctx, label, mode):
+    blocks = catlist(["<li><span class='textbf'>"])
+    blocks.extend(process_recursively(ctx, label, mode))
+    blocks.append('</span>')
+    return blocks
+
+def process_items(ctx, env, tag, process_label, mode):
+    """ A list, built from the items of its body in one pass
+
+        Each item body goes straight to process_recursively(), and the
+        items of nested lists are left for their own environments.
+    """
+    newblocks = catlist(['<{} class="{}">'.format(tag, env.name)])
+    preamble, items = list_items(env.content)
+    if preamble.strip():
+        newblocks.extend(process_recursively(ctx, preamble.strip(), mode))
+    for (label, body) in items:
+        if label is None:
+            newblocks.append('<li>')
+            body = body.strip()
+        else:
+            newblocks.extend(process_label(ctx, label, mode))
+            body = body.rstrip()
+        newblocks.extend(process_recursively(ctx, body, mode))
+        newblocks.append('</li>')
+    newblocks.append('</{}>'.format(tag))
     return newblocks
 
-def process_description_items(b):
-    b = re.sub(r'\\item\[(.+?)\]', '\1\\\\textbf{\\1}', b, 1)
-    b = re.sub(r'\\item\[(.+?)\]', '\2\1\\\\textbf{\\1}', b)
-    b = re.sub(r'\s*' + '\1' + r'\s*', '<li>', b, 0, re.M|re.S)
-    b = re.sub(r'\s*' + '\2' + r'\s*', '</li>', b, 0, re.M|re.S)
-    return b
+# The tokens that structure the body of a tabular environment. Escaped
+# characters and entities (like the &nbsp; from a ~) are not cell breaks.
+tabular_token_rx = re.compile(r'\\(?:begin|end)(?![a-zA-Z])'
+                              r'|\\t2hlinebreak(?![a-zA-Z])(?:\s*\[[^\]]*\])?'
+                              r'|\\hline(?![a-zA-Z])|\\cline\s*{[^}]*}'
+                              r'|\\.|&(?:[a-zA-Z]+|#\w+);|[{}&]')
+
+def tabular_columns(spec):
+    """ Parse a tabular column spec like |l|p{3cm}|c|
+
+        The result has a dict for each column, with its alignment, its
+        width (if any) and whether it has rules on its left and right.
+    """
+    columns = []
+    rule = False
+    i = 0
+    while i < len(spec):
+        c = spec[i]
+        i += 1
+        if c == '|':
+            rule = True
+        elif c in 'lcrpmb':
+            column = {'align': {'c': 'center', 'r': 'right'}.get(c, 'left'),
+                      'width': None, 'left': rule, 'right': False}
+            if c in 'pmb':
+                j, k = match_parens(spec, i, '{', '}')
+                column['width'] = spec[j+1:k-1]
+                i = k
+            columns.append(column)
+            rule = False
+        elif c == '*':
+            j, k = match_parens(spec, i, '{', '}')
+            n = spec[j+1:k-1]
+            j, i = match_parens(spec, k, '{', '}')
+            if n.strip().isdigit():
+                spec = spec[:j] + spec[j+1:i-1]*int(n) + spec[i:]
+                i = j
+        elif c in '@<>!':
+            i = match_parens(spec, i, '{', '}')[1]
+    if rule and columns:
+        columns[-1]['right'] = True
+    return columns
+
+def tabular_rows(tex):
+    """ Split the body of a tabular environment into rows of cells
+
+        Only the top-level & and \\\\ separate cells and rows; the ones
+        inside groups and nested environments are left alone. The result
+        is a list of (cells, rule above) pairs, and whether there is a rule
+        below the last row.
+    """
+    rows = []
+    cells = []
+    rule = False
+    depth = 0
+    start = 0
+    for m in tabular_token_rx.finditer(tex):
+        token = m.group(0)
+        if token == '{' or token == r'\begin':
+            depth += 1
+        elif token == '}' or token == r'\end':
+            depth -= 1
+        elif depth > 0:
+            continue
+        elif token == '&':
+            cells.append(tex[start:m.start()])
+            start = m.end()
+        elif token.startswith(r'\t2hlinebreak'):
+            cells.append(tex[start:m.start()])
+            rows.append((cells, rule))
+            cells = []
+            rule = False
+            start = m.end()
+        elif token == r'\hline' or token.startswith(r'\cline'):
+            if not tex[start:m.start()].strip() and not cells:
+                rule = True
+            start = m.end()
+    cells.append(tex[start:])
+    if len(cells) > 1 or cells[0].strip():
+        rows.append((cells, rule))
+        rule = False
+    return rows, rule
+
+def tabular_cell_style(column, above, below):
+    styles = []
+    if column:
+        styles.append('text-align:{}'.format(column['align']))
+        if column['width']:
+            styles.append('width:{}'.format(column['width']))
+        if column['left']:
+            styles.append('border-left:1px solid')
+        if column['right']:
+            styles.append('border-right:1px solid')
+    if above:
+        styles.append('border-top:1px solid')
+    if below:
+        styles.append('border-bottom:1px solid')
+    return ' style="{}"'.format(';'.join(styles)) if styles else ''
 
 def process_tabular_env(ctx, tex, env, mode):
-    # TODO: use a catlist of strings instead
+    """ A table, built from the rows and cells of the source
+
+        Columns get their alignment, width and rules from the column spec,
+        and \\multicolumn cells span several columns.
+    """
     mode |= TABULAR
-    inner = "".join(process_recursively(ctx, env.content, mode))
-    print(inner)
-    rows = re.split(r'\\\\(?:\[[^\\]]+\])?', inner)
-    rows = [re.split(r'\&', r) for r in rows]
-    table = '<table align="center">'
-    for r in rows:
-        table += '<tr>'
-        for c in r:
-            table += '<td>' + c + '</td>'
-        table += '</tr>'
-    table += '</table>'
-    return catlist([table])
+    columns = tabular_columns(env.args[0] if env.args else '')
+    rows, rule_below = tabular_rows(env.content)
+    ruled = False
+    blocks = catlist()
+    for (i, (cells, rule_above)) in enumerate(rows):
+        below = rule_below and i == len(rows) - 1
+        blocks.append('<tr>')
+        col = 0
+        for cell in cells:
+            span = 1
+            column = columns[col] if col < len(columns) else None
+            m = multicolumn_rx.match(cell)
+            if m:
+                cmd = next_command(cell, m.start(1))
+                if len(cmd.args) == 3 and cmd.args[0].strip().isdigit():
+                    span = int(cmd.args[0])
+                    column = (tabular_columns(cmd.args[1]) or [None])[0]
+                    cell = cmd.args[2] + cell[cmd.end:]
+            style = tabular_cell_style(column, rule_above, below)
+            ruled = ruled or 'border' in style
+            attrs = ' colspan="{}"'.format(span) if span > 1 else ''
+            blocks.append('<td{}{}>'.format(attrs, style))
+            blocks.extend(process_recursively(ctx, cell.strip(), mode))
+            blocks.append('</td>')
+            col += span
+        blocks.append('</tr>')
+    blocks.append('</table>')
+    table = catlist(['<table align="center"{}>'.format(
+        ' style="border-collapse:collapse"' if ruled else '')])
+    table.extend(blocks)
+    return table
+
+multicolumn_rx = re.compile(r'\s*(\\multicolumn)(?![a-zA-Z])')
+
+def process_multicolumn_cmd(ctx, tex, cmd, mode):
+    """ A \\multicolumn outside of a tabular is just its content """
+    if len(cmd.args) < 3:
+        return catlist()
+    return process_recursively(ctx, cmd.args[2], mode)
 
 def process_theoremlike_env(ctx, tex, env, mode):
     newblocks = catlist(['<div class="{}">'.format(env.name)])
@@ -748,66 +1305,305 @@ def process_recursively(ctx, tex, mode):
     newblocks.append(tex[lastidx:])
     return newblocks
 
+#
+# Parallel processing of the sections of a chapter
+#
+footnote_rx = re.compile(r'\\footnote(?![a-zA-Z0-9])')
+
+def split_sections(tex):
+    """ Split tex just before each top-level \\section command
+
+        The pieces are exactly the ones process_recursively() would walk
+        through one after the other.
+    """
+    starts = [0]
+    cmd = next_command(tex, 0)
+    while cmd:
+        if cmd.name == 'begin':
+            pos = get_environment(tex, cmd).end
+        else:
+            if cmd.name == 'section':
+                starts.append(cmd.start)
+            pos = cmd.end
+        cmd = next_command(tex, pos)
+    starts.append(len(tex))
+    return [tex[starts[i]:starts[i+1]] for i in range(len(starts)-1)]
+
+def process_sections(ctx, tex):
+    """ Process tex, using ctx.jobs processes for its top-level sections
+
+        Once process_labels() has run, sections only share the footnote
+        counter, the table of contents and the bookkeeping in ctx. Each
+        worker gets a precomputed footnote base and returns everything it
+        changed, which is merged back in document order. If a footnote
+        count turns out to be wrong, we start over serially, so the output
+        is always identical to that of process_recursively().
+    """
+    global _worker_ctx
+    pieces = split_sections(tex) if ctx.jobs > 1 else []
+    if len(pieces) < 2:
+        return "".join(process_recursively(ctx, tex, 0))
+
+    jobs = []
+    base = ctx.footnote_counter
+    for piece in pieces:
+        jobs.append((piece, base))
+        base += len(footnote_rx.findall(piece))
+
+    _worker_ctx = ctx
+    mp = multiprocessing.get_context('fork')
+    with stage(ctx, 'workers', sections=len(pieces)):
+        with mp.Pool(min(ctx.jobs, len(pieces))) as pool:
+            results = pool.map(process_section_worker, jobs)
+    _worker_ctx = None
+
+    footnotes = [r['footnote_counter'] for r in results]
+    if footnotes != [b for (p, b) in jobs[1:]] + [base]:
+        warn("Footnote count mismatch, processing sections serially")
+        return "".join(process_recursively(ctx, tex, 0))
+
+    for r in results:
+        if r['title'] is not None:
+            ctx.title = r['title']
+        for entry in r['toc']:
+            ctx.toc.append(entry)
+        ctx.label_map.update(r['label_map'])
+        ctx.id_ordinals.update(r['id_ordinals'])
+        ctx.used_ids |= r['used_ids']
+        ctx.graphics_files |= r['graphics_files']
+        ctx.cited_keys |= r['cited_keys']
+        ctx.math_features |= r['math_features']
+        ctx.listings.update(r['listings'])
+        ctx.dependencies |= r['dependencies']
+        if ctx.tracer:
+            ctx.tracer.events.extend(r['trace_events'])
+        if ctx.memory:
+            ctx.memory.add(r['memory_records'])
+        ctx.unprocessed_commands |= r['unprocessed_commands']
+        ctx.unprocessed_environments |= r['unprocessed_environments']
+    ctx.footnote_counter = base
+    return "".join([r['html'] for r in results])
+
+# The context of the parent process, inherited by forked workers
+_worker_ctx = None
+
+def process_section_worker(job):
+    """ Process one piece of a chapter for process_sections() """
+    tex, footnote_base = job
+    parent = _worker_ctx
+    ctx = copy.copy(parent)
+    ctx.footnote_counter = footnote_base
+    ctx.toc = []
+    ctx.label_map = dict(parent.label_map)
+    ctx.id_ordinals = copy.copy(parent.id_ordinals)
+    ctx.used_ids = set(parent.used_ids)
+    ctx.graphics_files = set()
+    ctx.cited_keys = set()
+    ctx.math_features = set()
+    ctx.listings = dict()
+    ctx.dependencies = set()
+    ctx.unprocessed_commands = set()
+    ctx.unprocessed_environments = set()
+    ctx.tracer = parent.tracer.fork() if parent.tracer else None
+    ctx.memory = parent.memory.fork() if parent.memory else None
+    with stage(ctx, 'section', footnote_base=footnote_base):
+        html = "".join(process_recursively(ctx, tex, 0))
+    return {'html': html,
+            'title': ctx.title if ctx.title != parent.title else None,
+            'toc': list(ctx.toc),
+            'label_map': {k: v for k, v in ctx.label_map.items()
+                          if parent.label_map.get(k) != v},
+            'id_ordinals': {k: v for k, v in ctx.id_ordinals.items()
+                            if parent.id_ordinals.get(k) != v},
+            'used_ids': ctx.used_ids - parent.used_ids,
+            'graphics_files': ctx.graphics_files,
+            'cited_keys': ctx.cited_keys,
+            'math_features': ctx.math_features,
+            'listings': ctx.listings,
+            'dependencies': ctx.dependencies,
+            'unprocessed_commands': ctx.unprocessed_commands,
+            'unprocessed_environments': ctx.unprocessed_environments,
+            'footnote_counter': ctx.footnote_counter,
+            'trace_events': ctx.tracer.events if ctx.tracer else [],
+            'memory_records': ctx.memory.records if ctx.memory else []}
+
 def cleanup_oldschool(tex):
     # Cleanup some old school tex font control
-    tex = re.sub(r'{\s*\\em', r'\\emph{', tex)
-    tex = re.sub(r'{\s*\\bf', r'\\textbf{', tex)
+    tex = re.sub(r'{\s*\\em(?![a-zA-Z])', r'\\emph{', tex)
+    tex = re.sub(r'{\s*\\bf(?![a-zA-Z])', r'\\textbf{', tex)
     tex = re.sub(r"``", '“', tex)
     tex = re.sub(r"''", '”', tex)
     # TODO: Do something about single-quotes
     return tex
 
-def cleanup_accented_chars(tex):
-    mapper = [("'",'e','é'),
-              ("'",'o','ó'),
-              ("'",'c','ć'),
-              ("'",r'\\i','í'),
-              ('"',r'\\i','ï')]
-    for m in mapper:
-        pattern = r'\\{cmd}(\s*{arg}|\{{{arg}\}})'.format(cmd=m[0], arg=m[1])
-        tex = re.sub(pattern, m[2], tex)
-    # Note: \'a = á but \varphi != ăphi
-    mapper = [('u','a','ă'),
-              ('v','a','ă'),   # FIXME: Not quite
-              ('c','s','ş')]
-    for m in mapper:
-        pattern = r'\\{cmd}(\s+{arg}|\{{{arg}\}})'.format(cmd=m[0], arg=m[1])
-        tex = re.sub(pattern, m[2], tex)
-    for x in ['`', "'", '"']:
-        pattern = r'\\{}'.format(x)
-        m = re.search(pattern, tex)
-        if m:
-            warn("Unhandled accent: {}".format(tex[m.start():min(len(tex),
-                                                                 m.start()+8)]))
-    return tex
+# LaTeX accent commands and the Unicode combining marks they stand for
+accent_marks = {"'": '\u0301',   # acute
+                '`': '\u0300',   # grave
+                '^': '\u0302',   # circumflex
+                '"': '\u0308',   # diaeresis
+                '~': '\u0303',   # tilde
+                '=': '\u0304',   # macron
+                '.': '\u0307',   # dot above
+                'u': '\u0306',   # breve
+                'v': '\u030c',   # caron
+                'H': '\u030b',   # double acute
+                'c': '\u0327',   # cedilla
+                'k': '\u0328'}   # ogonek
+
+# LaTeX text symbols that stand for a single character
+text_symbols = {'ss': 'ß', 'o': 'ø', 'O': 'Ø', 'aa': 'å', 'AA': 'Å',
+                'ae': 'æ', 'AE': 'Æ', 'oe': 'œ', 'OE': 'Œ', 'l': 'ł',
+                'L': 'Ł', 'i': 'ı', 'j': 'ȷ', 'ng': 'ŋ', 'NG': 'Ŋ',
+                'dh': 'ð', 'DH': 'Ð', 'th': 'þ', 'TH': 'Þ'}
+
+def make_accent_table():
+    """ Map (accent, base) to every precomposed character Unicode has """
+    table = dict()
+    letters = [chr(c) for c in range(ord('A'), ord('Z')+1)] \
+              + [chr(c) for c in range(ord('a'), ord('z')+1)]
+    for accent, mark in accent_marks.items():
+        for base in letters:
+            c = unicodedata.normalize('NFC', base + mark)
+            if len(c) == 1:
+                table[(accent, base)] = c
+        # The accent takes the place of the dot in \'\i and \v\j
+        for base in ['i', 'j']:
+            if (accent, base) in table:
+                table[(accent, '\\' + base)] = table[(accent, base)]
+    return table
+
+accent_table = make_accent_table()
+
+# Symbol accents may be followed by spaces, letter accents need a space or
+# a brace (\v a but not \varphi); the base is a letter, \i or \j, braced or
+# not. Text symbols must not be the prefix of a longer command (\o, \omega)
+# and, like in LaTeX, eat the spaces after them (Stra\ss e)
+accent_rx = re.compile(r'\\(?:([`' + "'" + r'^"~=.])\s*|([uvHck])(?:\s+|(?={)))'
+                       r'(?:{\s*(\\[ij](?![a-zA-Z])|[a-zA-Z])\s*}'
+                       r'|(\\[ij](?![a-zA-Z])|[a-zA-Z]))'
+                       r'|\\(' + '|'.join(sorted(text_symbols, key=len, reverse=True))
+                       + r')(?![a-zA-Z])(?:{}|[ \t]*)')
+
+def translate_accent(m, redefined=frozenset(), unhandled=None):
+    """ The character for the accent or text symbol matched by m, unless
+        its command is in redefined
+
+        Accents without a character are added to unhandled, or warned
+        about if that is None.
+    """
+    if m.group(5):
+        if m.group(5) in redefined:
+            return m.group(0)
+        return text_symbols[m.group(5)]
+    accent = m.group(1) or m.group(2)
+    if accent in redefined:
+        return m.group(0)
+    base = m.group(3) or m.group(4)
+    c = accent_table.get((accent, base))
+    if c is None:
+        if unhandled is None:
+            warn("Unhandled accent: {}".format(m.group(0)))
+        else:
+            unhandled.add(m.group(0))
+        return m.group(0)
+    return c
+
+# Where accents and text symbols are left alone: math, where \O and \l
+# are often macros and \. and \= mean something else; verbatim text and
+# code; and tabbing, where \= and \' set and use tab stops
+accent_free_environments = ['equation', 'equation*', 'align', 'align*',
+                            'eqnarray', 'eqnarray*', 'gather', 'gather*',
+                            'multline', 'multline*', 'displaymath', 'math',
+                            'verbatim', 'verbatim*', 'lstlisting', 'tabbing']
+accent_free_rx = re.compile(r'(?<!\\)\$\$.*?(?<!\\)\$\$'
+                            r'|(?<!\\)\$(?:[^$\\]|\\.)*\$'
+                            r'|\\\(.*?\\\)|\\\[.*?\\\]'
+                            r'|\\begin\s*{('
+                            + '|'.join([re.escape(e)
+                                        for e in accent_free_environments])
+                            + r')}.*?\\end\s*{\1}'
+                            r'|\\verb\*?([^a-zA-Z\s*]).*?\2', re.S)
+
+# Commands defined by the document itself
+newcommand_rx = re.compile(r'\\(?:(?:re)?newcommand|providecommand'
+                           r'|DeclareRobustCommand)\*?\s*{?\s*\\([a-zA-Z]+|.)'
+                           r'|\\def\s*\\([a-zA-Z]+|.)')
+
+def cleanup_accented_chars(ctx, tex):
+    """ Replace accented characters and text symbols with Unicode, in one pass
+
+        Math, verbatim text, tabbing and the commands that tex defines
+        itself are left alone. Accents that have no character are left
+        alone too, and added to ctx.unhandled_accents.
+    """
+    redefined = set([m.group(1) or m.group(2)
+                     for m in newcommand_rx.finditer(tex)])
+    translate = lambda m: translate_accent(m, redefined,
+                                           ctx.unhandled_accents)
+    blocks = []
+    i = 0
+    for m in accent_free_rx.finditer(tex):
+        blocks.append(accent_rx.sub(translate, tex[i:m.start()]))
+        blocks.append(m.group(0))
+        i = m.end()
+    blocks.append(accent_rx.sub(translate, tex[i:]))
+    return "".join(blocks)
 
-def tex2htm(ctx, tex, chapter):
-    # Some preprocessing
-    tex = ods.preprocess_hashes(tex) # TODO: ods specific
+def preprocess(ctx, tex, chapter, counters=None):
+    """ Preprocess tex and process its labels, ready for process_recursively """
+    for f in ctx.early_filters:
+        tex = f(tex)
     tex = strip_comments(tex)
     tex = re.sub(r'\\%', "%", tex)
     tex = cleanup_oldschool(tex)
-    tex = cleanup_accented_chars(tex)
+    tex = cleanup_accented_chars(ctx, tex)
     tex = split_paragraphs(tex)
+    # A space keeps a line break from running into the word after it
+    tex = re.sub(r'\\\\(?=[a-zA-Z])', r'\\t2hlinebreak ', tex)
     tex = re.sub(r'\\\\', r'\\t2hlinebreak', tex)
     tex = re.sub(r'([^\\])\\\[', r'\1\\begin{equation*}', tex)
-    tex = re.sub(r'([^\\])\\\]', r'\1\end{equation*}', tex)
+    tex = re.sub(r'([^\\])\\\]', r'\1\\end{equation*}', tex)
     tex = re.sub(r'\\\$', 'DOLLABILLYALL', tex)
     tex = re.sub(r'\$([^\$]*(\\\$)?)\$', r'\\begin{dollar}\1\\end{dollar}', tex,
                  0, re.M|re.S)
     tex = re.sub(r'DOLLABILLYALL', '$', tex)
     tex = re.sub(r'([^\\])\~', r'\1&nbsp;', tex)
-    tex = re.sub(r'\\myeqref', '\\eqref', tex)
+    tex = re.sub(r'\\myeqref', r'\\eqref', tex)
     tex = re.sub(r'---', r'&mdash;', tex)
     tex = re.sub(r'--', r'&ndash;', tex)
-    tex = ods.convert_hashes(tex) # TODO: ods specific
+    for f in ctx.late_filters:
+        tex = f(tex)
     tex = re.sub(r'\\#', '#', tex)
 
-    tex = process_labels(ctx, tex, chapter)
+    with stage(ctx, 'process_labels'):
+        return process_labels(ctx, tex, chapter, counters)
 
-    blocks = process_recursively(ctx, tex, 0)
-    tex = "".join(blocks)
+def tex2htm(ctx, tex, chapter, counters=None, finish=True):
+    """ Translate tex, the whole of chapter chapter or a piece of it
 
+        Pieces are translated with counters, that carry on from the piece
+        before, and without finish, so that postprocess() can be applied
+        to the pieces put together.
+    """
+    ctx.chapter = chapter
+
+    # Some preprocessing
+    with stage(ctx, 'preprocess'):
+        tex = preprocess_cached(ctx, tex, chapter, counters)
+
+    with stage(ctx, 'process_sections'):
+        tex = process_sections(ctx, tex)
+
+    if finish:
+        with stage(ctx, 'postprocess'):
+            tex = postprocess(tex)
+    return tex
+
+def postprocess(tex):
+    """ The last touches to the text of a whole document
+
+        These only look at a line at a time, or at the end of tex.
+    """
     #tex = re.sub(r'\\}', '}', tex)
     #tex = re.sub(r'\\{', '{', tex)
     #tex = re.sub(r'\\\\', '<br/>', tex)
@@ -818,14 +1614,270 @@ def tex2htm(ctx, tex, chapter):
     tex = re.sub(r'\verb+\^+', r'\&Hat;', tex)
     return tex
 
-def generate_graphics_files(filenames, basedir):
+#
+# Bibliographies
+#
+bibitem_rx = re.compile(r'\\bibitem\s*(?:\[[^\]]*\])?\s*{((?:\w|:|-)+)}')
+
+def parse_thebibliography(ctx, tex):
+    """ Split the content of a thebibliography environment into entries
+
+        The result is a list of (key, body) pairs in the order of tex, and
+        is kept in ctx.cachedir.
+    """
+    digest = hashlib.sha256(converter_version(ctx).encode('utf-8'))
+    digest.update(tex.encode('utf-8'))
+    cachefile = digest.hexdigest() + '.bbl'
+    entries = load_cached(ctx, cachefile)
+    if entries is None:
+        entries = []
+        matches = list(bibitem_rx.finditer(tex))
+        for i in range(len(matches)):
+            m = matches[i]
+            end = matches[i+1].start() if i+1 < len(matches) else len(tex)
+            body = tex[m.end():end].replace('<p>', '').strip()
+            entries.append((m.group(1), body))
+        store_cached(ctx, cachefile, entries)
+    return entries
+
+bib_entry_rx = re.compile(r'@(\w+)\s*{')
+bib_field_rx = re.compile(r'\s*,?\s*([^\s=,{}]+)\s*=\s*')
+# Numbers and the names of @string macros
+bib_word_rx = re.compile(r'[^\s=,{}"#]+')
+
+# The macros that every BibTeX style defines
+bib_months = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+              'August', 'September', 'October', 'November', 'December']
+
+def parse_bib(tex):
+    """ Parse a BibTeX database into a list of (key, type, fields) triples
+
+        Values can use the @string macros defined before them, and join
+        their parts with #.
+    """
+    entries = []
+    strings = {m[:3].lower(): m for m in bib_months}
+    m = bib_entry_rx.search(tex)
+    while m:
+        kind = m.group(1).lower()
+        j0, j = match_parens(tex, m.end()-1, '{', '}')
+        if kind == 'string':
+            strings.update(parse_bib_fields(tex[j0+1:j-1], '@string',
+                                            strings))
+        elif kind not in ['comment', 'preamble']:
+            entries.append(parse_bib_entry(tex[j0+1:j-1], kind, strings))
+        m = bib_entry_rx.search(tex, j)
+    return entries
+
+def parse_bib_entry(body, kind, strings=dict()):
+    key, _, body = body.partition(',')
+    key = key.strip()
+    return (key, kind, parse_bib_fields(body, key, strings))
+
+def parse_bib_fields(body, key, strings):
+    """ The fields in body, the text of the bibliography entry key after
+        its key, as a dictionary with lowercase names
+    """
+    fields = dict()
+    j = 0
+    m = bib_field_rx.match(body)
+    while m:
+        value, j = parse_bib_value(body, m.end(), m.group(1), key, strings)
+        fields[m.group(1).lower()] = re.sub(r'\s+', ' ', value)
+        m = bib_field_rx.match(body, j)
+    rest = body[j:].strip()
+    if rest and rest != ',':
+        abort("Cannot parse \"{}\" in bibliography entry {}".format(
+              rest[:25], key))
+    return fields
+
+def parse_bib_value(body, i, name, key, strings):
+    """ Parse the value of the field name that starts at body[i]
+
+        The result is the value, with its parts joined and its macros
+        expanded, and the position after it.
+    """
+    parts = []
+    while True:
+        i = skip_space(body, i)
+        if body.startswith('{', i):
+            j0, j = match_parens(body, i, '{', '}')
+            parts.append(body[j0+1:j-1])
+        elif body.startswith('"', i):
+            j = body.find('"', i+1) + 1
+            if j == 0:
+                abort("Unterminated \"{}\" in bibliography entry {}".format(
+                      name, key))
+            parts.append(body[i+1:j-1])
+        else:
+            m = bib_word_rx.match(body, i)
+            if not m:
+                abort("Missing value of \"{}\" in bibliography entry {}"
+                      .format(name, key))
+            j = m.end()
+            word = m.group(0)
+            if word.isdigit():
+                parts.append(word)
+            elif word.lower() in strings:
+                parts.append(strings[word.lower()])
+            else:
+                warn("Undefined string {} in bibliography entry {}".format(
+                     word, key))
+        j = skip_space(body, j)
+        if not body.startswith('#', j):
+            return "".join(parts), j
+        i = j + 1
+
+def format_bib_names(names):
+    names = [n.strip() for n in re.split(r'\s+and\s+', names)]
+    names = [' '.join(reversed([p.strip() for p in n.split(',', 1)]))
+             for n in names]
+    if len(names) <= 2:
+        return ' and '.join(names)
+    return ', '.join(names[:-1]) + ', and ' + names[-1]
+
+def format_bib_entry(kind, fields):
+    """ Typeset a BibTeX entry, more or less the way the plain style does """
+    blocks = []
+    if 'author' in fields:
+        blocks.append(format_bib_names(fields['author']) + '.')
+    if 'title' in fields:
+        if kind in ['book', 'phdthesis', 'mastersthesis']:
+            blocks.append(r'{\em ' + fields['title'] + '}.')
+        else:
+            blocks.append(fields['title'] + '.')
+    venue = []
+    if 'journal' in fields:
+        venue.append(r'{\em ' + fields['journal'] + '}')
+    if 'booktitle' in fields:
+        venue.append(r'In {\em ' + fields['booktitle'] + '}')
+    if 'volume' in fields:
+        volume = fields['volume']
+        if 'number' in fields:
+            volume += '(' + fields['number'] + ')'
+        venue.append(volume)
+    if 'pages' in fields:
+        venue.append('pages ' + fields['pages'])
+    for name in ['publisher', 'school', 'institution', 'year']:
+        if name in fields:
+            venue.append(fields[name])
+    if venue:
+        blocks.append(', '.join(venue) + '.')
+    return '\n\\newblock '.join(blocks)
+
+def bib_to_thebibliography(ctx, tex):
+    """ Turn a BibTeX database into a thebibliography environment
+
+        Entries keep the order of the database. The parsed database is
+        kept in ctx.cachedir.
+    """
+    digest = hashlib.sha256(converter_version(ctx).encode('utf-8'))
+    digest.update(tex.encode('utf-8'))
+    cachefile = digest.hexdigest() + '.bib'
+    entries = load_cached(ctx, cachefile)
+    if entries is None:
+        entries = parse_bib(tex)
+        store_cached(ctx, cachefile, entries)
+    blocks = [r'\begin{{thebibliography}}{{{}}}'.format(len(entries))]
+    for (key, kind, fields) in entries:
+        blocks.append('\\bibitem{{{}}}\n{}\n'.format(key,
+                                                  format_bib_entry(kind, fields)))
+    blocks.append(r'\end{thebibliography}')
+    return '\n'.join(blocks)
+
+#
+# Caching of preprocessed documents
+#
+def converter_version(ctx):
+    """ A digest of the code of tex2htm and its plugins """
+    if ctx.version is None:
+        digest = hashlib.sha256()
+        for module in [sys.modules[__name__]] + ctx.plugins:
+            with open(module.__file__, 'rb') as fp:
+                digest.update(fp.read())
+        ctx.version = digest.hexdigest()
+    return ctx.version
+
+def preprocess_cached(ctx, tex, chapter, counters=None):
+    """ Like preprocess(), but keeps the result in ctx.cachedir
+
+        Besides the preprocessed text, an entry records what
+        process_labels() added to ctx, so a later run (for instance one
+        that renders another output variant) can skip straight to
+        process_recursively(). Entries are keyed by a digest of the
+        source, the converter code and the numbering state, so editing
+        either one invalidates them.
+    """
+    if not ctx.cachedir and ctx.parse_cache is None:
+        return preprocess(ctx, tex, chapter, counters)
+    state = sorted(counters.__dict__.items()) if counters else None
+    key = hashlib.sha256(repr((converter_version(ctx), ctx.outputfile,
+                               chapter, state)).encode('utf-8'))
+    key.update(tex.encode('utf-8'))
+    cachefile = key.hexdigest() + '.parse'
+    entry = None
+    if ctx.parse_cache is not None:
+        entry = ctx.parse_cache.get(key.hexdigest())
+    if not entry:
+        entry = load_cached(ctx, cachefile)
+    if entry:
+        if ctx.parse_cache is not None:
+            ctx.parse_cache[key.hexdigest()] = entry
+        ctx.label_map.update(entry['label_map'])
+        ctx.id_ordinals.update(entry['id_ordinals'])
+        ctx.used_ids |= entry['used_ids']
+        if counters:
+            counters.__dict__.update(entry['counters'])
+        return entry['tex']
+
+    label_map = dict(ctx.label_map)
+    id_ordinals = dict(ctx.id_ordinals)
+    used_ids = set(ctx.used_ids)
+    tex = preprocess(ctx, tex, chapter, counters)
+    entry = {'tex': tex,
+             'label_map': {k: v for k, v in ctx.label_map.items()
+                           if label_map.get(k) != v},
+             'id_ordinals': {k: v for k, v in ctx.id_ordinals.items()
+                             if id_ordinals.get(k) != v},
+             'used_ids': ctx.used_ids - used_ids,
+             'counters': copy.deepcopy(counters.__dict__) if counters else None}
+    if ctx.parse_cache is not None:
+        ctx.parse_cache[key.hexdigest()] = entry
+    store_cached(ctx, cachefile, entry)
+    return tex
+
+def load_cached(ctx, name):
+    """ The value stored under name in ctx.cachedir, or None """
+    if not ctx.cachedir:
+        return None
+    try:
+        with open(ctx.cachedir + os.path.sep + name, 'rb') as fp:
+            return pickle.loads(zlib.decompress(fp.read()))
+    except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+        return None
+
+def store_cached(ctx, name, value):
+    """ Store value under name in ctx.cachedir, as a compressed pickle """
+    if not ctx.cachedir:
+        return
+    os.makedirs(ctx.cachedir, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=ctx.cachedir, prefix='.tex2htm-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+    os.replace(tmpname, ctx.cachedir + os.path.sep + name)
+
+def generate_graphics_files(ctx, filenames, basedir):
+    """ Render the SVG files in filenames from their Ipe drawings
+
+        Files are rendered if they are missing or older than the drawing.
+    """
     filenames = [basedir+os.path.sep+f for f in filenames]
-    filenames = [f for f in filenames if not os.path.isfile(f)]
     fp = open('/dev/null', 'w')
     for f in filenames:
         f, ext = os.path.splitext(f)
         if ext != '.svg':
-            warn("Unknown graphics type: {} for {}".format(ext, f+ext))
+            if not os.path.isfile(f+ext):
+                warn("Unknown graphics type: {} for {}".format(ext, f+ext))
             continue
         m = re.search(r'(.*)-(\d+)$', f)
         cmd = ['iperender', '-svg']
@@ -836,14 +1888,216 @@ def generate_graphics_files(filenames, basedir):
         else:
             ipefile = f + ".ipe"
         svgfile = f + ext
+        if os.path.isfile(ipefile):
+            record_dependency(ctx, ipefile)
+        if os.path.isfile(svgfile) and not (os.path.isfile(ipefile)
+                and os.path.getmtime(ipefile) > os.path.getmtime(svgfile)):
+            continue
         cmd.extend([ipefile, svgfile])
-        status = subprocess.call(cmd, stdin=fp, stdout=fp, stderr=fp)
+        with stage(ctx, cmd[0], file=svgfile):
+            status = subprocess.call(cmd, stdin=fp, stdout=fp, stderr=fp)
         if status:
             msg = "{} gave non-zero exit status for {}".format(cmd[0], ipefile)
             warn(msg)
     fp.close()
 
-def finish_crossrefs(filename, label_map, html):
+#
+# Figures
+#
+svg_junk_rx = re.compile(r'<\?xml.*?\?>|<!--.*?-->|<metadata\b.*?</metadata>'
+                         r'|<metadata\b[^>]*/>', re.S)
+svg_numbers_rx = re.compile(r'\b((?:d|points)=")([^"]*)"')
+svg_number_rx = re.compile(r'-?\d+\.\d+')
+svg_transform_rx = re.compile(r'\btransform="([^"]*)"')
+svg_scale_rx = re.compile(r'(matrix|scale)\s*\(([^)]*)\)')
+svg_group_rx = re.compile(r'<g(\s[^>]*)?(?<!/)>|</g>')
+svg_viewbox_rx = re.compile(r'<svg\b[^>]*\bviewBox="([^"]*)"')
+
+def short_number(s, decimals=2):
+    """ The number s with at most decimals decimals and no trailing zeros """
+    s = '{:.{}f}'.format(float(s), decimals).rstrip('0').rstrip('.')
+    return '0' if s == '-0' else s
+
+def svg_decimals(svg):
+    """ How many decimals the coordinates in svg's paths need, or None
+
+        Coordinates are kept to a millionth of the viewBox, taking into
+        account how much the transforms in svg could magnify them. Without
+        a viewBox there is no telling, so then the answer is None.
+    """
+    (width, height) = svg_size(svg)
+    if width is None:
+        return None
+    extent = max(float(width), float(height))
+    # An upper bound on the magnification of any chain of transforms
+    magnification = 1.0
+    for t in svg_transform_rx.finditer(svg):
+        for m in svg_scale_rx.finditer(t.group(1)):
+            try:
+                args = [abs(float(x)) for x in
+                        m.group(2).replace(',', ' ').split()]
+            except ValueError:
+                return None
+            if m.group(1) == 'matrix':
+                args = args[:4]
+            magnification *= max([1.0] + args)
+    if extent <= 0:
+        return None
+    resolution = extent / 1e6 / magnification
+    return max(0, math.ceil(-math.log10(resolution)))
+
+def optimize_svg(svg):
+    """ Strip the metadata and comments from svg, shorten the numbers in its
+        paths (see svg_decimals()) and unwrap the groups that have no
+        attributes
+    """
+    svg = svg_junk_rx.sub('', svg)
+    decimals = svg_decimals(svg)
+    if decimals is not None:
+        svg = svg_numbers_rx.sub(lambda m: m.group(1)
+                                 + svg_number_rx.sub(
+                                     lambda n: short_number(n.group(0),
+                                                            decimals),
+                                     m.group(2))
+                                 + '"', svg)
+    # A stack of the open groups, and whether each was kept
+    blocks = catlist()
+    kept = []
+    i = 0
+    for m in svg_group_rx.finditer(svg):
+        blocks.append(svg[i:m.start()])
+        i = m.end()
+        if m.group(0) == '</g>':
+            if not kept or kept.pop():
+                blocks.append(m.group(0))
+        elif m.group(1) and m.group(1).strip():
+            kept.append(True)
+            blocks.append(m.group(0))
+        else:
+            kept.append(False)
+    blocks.append(svg[i:])
+    svg = "".join(blocks)
+    if '<text' not in svg:
+        # Whitespace between tags only matters inside text
+        svg = re.sub(r'>\s+<', '><', svg)
+    return svg.strip() + '\n'
+
+def svg_size(svg):
+    """ The width and height of svg's viewBox, or (None, None) """
+    m = svg_viewbox_rx.search(svg)
+    if m:
+        box = m.group(1).replace(',', ' ').split()
+        if len(box) == 4:
+            try:
+                return (short_number(box[2]), short_number(box[3]))
+            except ValueError:
+                pass
+    return (None, None)
+
+def optimized_figure(ctx, filename):
+    """ The optimized (svg, width, height) of the SVG file filename
+
+        The file itself is left alone. Optimized figures are cached by the
+        hash of the file and of the converter, so unchanged figures are
+        never parsed twice. Returns None if there is no such file.
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return None
+    digest = hashlib.sha256(converter_version(ctx).encode('utf-8'))
+    digest.update(data)
+    name = digest.hexdigest() + '.svg'
+    figure = ctx.figure_cache.get(name) or load_cached(ctx, name)
+    if figure is None:
+        svg = optimize_svg(data.decode('utf-8'))
+        figure = (svg,) + svg_size(svg)
+        store_cached(ctx, name, figure)
+    ctx.figure_cache[name] = figure
+    return figure
+
+def optimized_figure_name(filename):
+    """ The name of the optimized copy of the figure filename """
+    return os.path.splitext(filename)[0] + '.min.svg'
+
+def write_optimized_figure(filename, svg):
+    """ Write svg to filename, unless it is there already """
+    data = svg.encode('utf-8')
+    if file_digest(filename) == hashlib.sha256(data).digest():
+        return
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                   prefix='.tex2htm-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmpname, filename)
+
+def finish_figures(ctx, html, dirname, offset=0):
+    """ Replace the FIGURE markers in html with the optimized figures
+
+        html starts offset characters into its page. Figures further than
+        ctx.fold_chars into the page are loaded lazily, small figures
+        without ids (that could clash with others) are inlined, and the
+        rest get their width and height so the page doesn't jump around
+        when they load.
+    """
+    blocks = catlist()
+    i = 0
+    for m in figure_rx.finditer(html):
+        blocks.append(html[i:m.start()])
+        i = m.end()
+        filename = m.group(1)
+        record_dependency(ctx, dirname + os.path.sep + filename)
+        figure = optimized_figure(ctx, dirname + os.path.sep + filename)
+        if figure is None:
+            warn("Missing figure: {}".format(filename))
+            figure = (None, None, None)
+        (svg, width, height) = figure
+        if svg and len(svg) <= ctx.inline_figure_bytes and ' id=' not in svg:
+            blocks.append(svg.replace('<svg', '<svg class="includegraphics"',
+                                      1).strip())
+            continue
+        if svg:
+            # Pages load an optimized copy; the source figure stays as it is
+            filename = optimized_figure_name(filename)
+            write_optimized_figure(dirname + os.path.sep + filename, svg)
+        ctx.figure_files.add(dirname + os.path.sep + filename)
+        attrs = ['class="includegraphics"', 'src="{}"'.format(filename)]
+        if width and height:
+            attrs.append('width="{}" height="{}"'.format(width, height))
+        if offset + m.start() > ctx.fold_chars:
+            attrs.append('loading="lazy"')
+        blocks.append('<img {}/>'.format(" ".join(attrs)))
+    blocks.append(html[i:])
+    return "".join(blocks)
+
+# Shared listings go in this directory, next to the pages
+listing_dir = 'listings'
+
+def share_listing(ctx, html, lines):
+    """ The markup for html, a highlighted listing with lines lines
+
+        With ctx.share_listings, listings longer than
+        ctx.inline_listing_lines go in ctx.listings, to be written once to
+        a file named by the hash of their content, and the page gets a
+        link that loads the file in place when it is scrolled into view or
+        clicked.
+    """
+    if not ctx.share_listings or lines <= ctx.inline_listing_lines:
+        return html
+    digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    name = '{}/{}.html'.format(listing_dir, digest[:20])
+    ctx.listings[name] = html
+    return ('<a class="listingloader" href="{0}" data-src="{0}"'
+            ' style="min-height:{1}em">Show code ({2} lines)</a>').format(
+                name, round(1.2*lines, 1), lines)
+
+def finish_crossrefs(ctx, filename, html):
+    """ Turn the CROSSREF markers in html, part of filename, into links
+
+        Links between pages go to the pages of ctx's output variant.
+    """
+    label_map = ctx.label_map
     blocks = catlist()
     i = 0
     for m in crossref_rx.finditer(html):
@@ -854,13 +2108,18 @@ def finish_crossrefs(filename, label_map, html):
         text = m.group(4)
         if texlabel not in label_map:
             ctx.undefined_labels.add(texlabel)
+            ctx.unresolved_pages.add(filename)
             blocks.append('<span class="error">REFERR:{}</span>'.format(texlabel))
         else:
             f, ell = label_map[texlabel]
             if filename == f:
                 htmllabel = "#{}".format(ell)
             else:
-                htmllabel = "{}#{}".format(relative_path(filename, f), ell)
+                links = ctx.page_links.setdefault(filename, defaultdict(int))
+                links[f] += 1
+                htmllabel = "{}#{}".format(relative_path(
+                    variant_filename(ctx, filename), variant_filename(ctx, f)),
+                    ell)
             if not text:
                 text = crossref_text(ctx, name, texlabel)
             blocks.append('<a href="{}">{}</a>'.format(htmllabel, text))
@@ -872,9 +2131,878 @@ def process_file(ctx, tex, dirname, chapter):
     htm = tex2htm(ctx, tex, chapter)
 
     # Generate any necessary graphics files
-    generate_graphics_files(ctx.graphics_files, dirname)
+    with stage(ctx, 'graphics'):
+        generate_graphics_files(ctx, ctx.graphics_files, dirname)
     ctx.graphics_files.clear()
-    return htm
+    with stage(ctx, 'figures'):
+        return finish_figures(ctx, htm, dirname)
+
+#
+# MathJax configuration
+#
+
+# The MathJax TeX extensions needed by math environments and commands.
+# Anything not listed here is handled by MathJax's TeX input on its own.
+mathjax_extensions = {'align': 'AMSmath.js', 'align*': 'AMSmath.js',
+                      'equation': 'AMSmath.js', 'gather': 'AMSmath.js',
+                      'gather*': 'AMSmath.js', 'multline': 'AMSmath.js',
+                      'multline*': 'AMSmath.js', 'split': 'AMSmath.js',
+                      'cases': 'AMSmath.js', 'eqref': 'AMSmath.js',
+                      'tag': 'AMSmath.js', 'label': 'AMSmath.js',
+                      'DeclareMathOperator': 'AMSmath.js',
+                      'operatorname': 'AMSmath.js', 'dfrac': 'AMSmath.js',
+                      'tfrac': 'AMSmath.js', 'binom': 'AMSmath.js',
+                      'dbinom': 'AMSmath.js', 'tbinom': 'AMSmath.js',
+                      'substack': 'AMSmath.js', 'intertext': 'AMSmath.js',
+                      'mathbb': 'AMSsymbols.js', 'mathfrak': 'AMSsymbols.js',
+                      'blacksquare': 'AMSsymbols.js', 'square': 'AMSsymbols.js',
+                      'varnothing': 'AMSsymbols.js', 'checkmark': 'AMSsymbols.js',
+                      'leqslant': 'AMSsymbols.js', 'geqslant': 'AMSsymbols.js',
+                      'lesssim': 'AMSsymbols.js', 'gtrsim': 'AMSsymbols.js',
+                      'nleq': 'AMSsymbols.js', 'ngeq': 'AMSsymbols.js',
+                      'nmid': 'AMSsymbols.js', 'therefore': 'AMSsymbols.js',
+                      'because': 'AMSsymbols.js', 'lll': 'AMSsymbols.js',
+                      'ggg': 'AMSsymbols.js',
+                      'color': 'color.js', 'textcolor': 'color.js',
+                      'colorbox': 'color.js', 'fcolorbox': 'color.js',
+                      'definecolor': 'color.js',
+                      'cancel': 'cancel.js', 'bcancel': 'cancel.js',
+                      'xcancel': 'cancel.js', 'cancelto': 'cancel.js',
+                      'boldsymbol': 'boldsymbol.js'}
+
+math_feature_rx = re.compile(r'\\begin\s*{(\w+\*?)}|\\([a-zA-Z]+)')
+mathjax_script_rx = re.compile(r'<script[^>]*MathJax.*?</script>\s*', re.S)
+mathjax_macros_rx = re.compile(r'\\\(\\newcommand.*?\\\)\s*', re.S)
+mathjax_extensions_rx = re.compile(r'(TeX:\s*{\s*extensions:\s*\[)[^\]]*(\])')
+
+def math_features(tex):
+    """ The math environments and commands used in tex """
+    return set([m.group(1) or m.group(2)
+                for m in math_feature_rx.finditer(tex)])
+
+def record_math_features(ctx, env):
+    """ Note the math used by env, so its page can configure MathJax """
+    ctx.math_features.add(env.name)
+    ctx.math_features |= math_features(env.content)
+
+def configure_mathjax(ctx, head, features):
+    """ Load only the MathJax extensions that a page with features needs
+
+        The macros defined in head count as features too, as they are
+        typeset with the rest of the page. Pages without math don't load
+        MathJax at all.
+    """
+    if not features:
+        head = mathjax_script_rx.sub('', head)
+        return mathjax_macros_rx.sub('', head)
+    features = features | set([f for m in mathjax_macros_rx.finditer(head)
+                                for f in math_features(m.group(0))])
+    extensions = sorted(set([mathjax_extensions[f] for f in features
+                             if f in mathjax_extensions]))
+    names = ",".join(['"{}"'.format(e) for e in extensions])
+    return mathjax_extensions_rx.sub(lambda m: m.group(1) + names + m.group(2),
+                                     head, 1)
+
+#
+# Navigation hints
+#
+asset_rx = re.compile(r'<(script|link)\b([^>]*)>')
+attribute_rx = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+def record_assets(ctx, filename, html):
+    """ Note the scripts and stylesheets used by the page filename """
+    assets = []
+    for m in asset_rx.finditer(html):
+        attrs = dict([(a.group(1).lower(), a.group(2) or a.group(3) or '')
+                      for a in attribute_rx.finditer(m.group(2))])
+        if m.group(1) == 'script' and attrs.get('src'):
+            assets.append((attrs['src'], 'script'))
+        elif attrs.get('rel') == 'stylesheet' and attrs.get('href'):
+            assets.append((attrs['href'], 'style'))
+    ctx.page_assets[filename] = assets
+    for asset in assets:
+        ctx.asset_counts[asset] += 1
+
+def link_hints(ctx, filename, nextfile):
+    """ <link> elements for what readers of filename are likely to need next
+
+        The next chapter and the pages that filename links to most often
+        are prefetched, up to ctx.max_link_hints of them. The links are
+        known once finish_crossrefs() has seen the whole page. The page's
+        own scripts and stylesheets are not hinted, as the tags that load
+        them are already in its <head>.
+    """
+    links = ctx.page_links.get(filename, dict())
+    targets = sorted(links, key=lambda f: -links[f])
+    if nextfile:
+        targets = [nextfile] + [f for f in targets if f != nextfile]
+    prefetches = []
+    for f in targets[:ctx.max_link_hints]:
+        url = relative_path(variant_filename(ctx, filename),
+                            variant_filename(ctx, f))
+        prefetches.append('<link rel="prefetch" href="{}">'.format(url))
+    return prefetches
+
+def add_link_hints(ctx, filename, nextfile, head):
+    """ Put the link_hints() for filename at the end of its <head> """
+    hints = "".join(['    {}\n'.format(h)
+                     for h in link_hints(ctx, filename, nextfile)])
+    return head.replace('  </head>', hints + '  </head>', 1)
+
+#
+# Offline reading
+#
+precache_manifest_name = 'precache-manifest.json'
+service_worker_name = 'sw.js'
+
+def register_service_worker(html):
+    """ Make the page in html install the book's service worker """
+    script = ("    <script>\n"
+              "      if ('serviceWorker' in navigator) {{\n"
+              "        navigator.serviceWorker.register('{}');\n"
+              "      }}\n"
+              "    </script>\n").format(service_worker_name)
+    return html.replace('  </head>', script + '  </head>', 1)
+
+def precache_manifest(ctxs, writer, outputdir):
+    """ The manifest of what the service worker keeps for offline reading
+
+        It maps the URL of every page written by writer, and of the local
+        scripts, stylesheets and figures that the pages of ctxs use, to a
+        revision that changes with the file's content.
+    """
+    outputdir = outputdir or '.'
+    digests = dict([(os.path.normpath(f), d)
+                    for (f, d) in writer.digests.items()])
+    assets = local_assets(ctxs)
+    for vctx in ctxs:
+        for filename in vctx.figure_files:
+            assets.add(os.path.relpath(filename, outputdir))
+    for url in assets:
+        filename = os.path.normpath(os.path.join(outputdir, *url.split('/')))
+        if filename not in digests:
+            digest = file_digest(filename)
+            if digest is None:
+                warn("Missing asset, not precached: {}".format(url))
+                continue
+            digests[filename] = digest
+    files = dict()
+    for filename in digests:
+        url = os.path.relpath(filename, outputdir).replace(os.path.sep, '/')
+        files[url] = digests[filename].hex()[:16]
+    return {'files': dict(sorted(files.items()))}
+
+def local_assets(ctxs):
+    """ The relative URLs of the scripts and stylesheets that the pages of
+        ctxs use
+    """
+    return set([url for vctx in ctxs for (url, kind) in vctx.asset_counts
+                if not re.match(r'(\w+:)?//', url)])
+
+def copy_assets(ctxs, writer, outputdir, basedir):
+    """ Copy the local_assets() that come with tex2htm, like pygments.css,
+        from basedir to outputdir
+    """
+    for url in sorted(local_assets(ctxs)):
+        source = os.path.join(basedir, *url.split('/'))
+        target = os.path.join(outputdir, *url.split('/'))
+        if os.path.isfile(source) and \
+           os.path.abspath(source) != os.path.abspath(target):
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            with open(source) as fp:
+                writer.write(target, fp.read())
+
+def write_offline_bundle(ctxs, writer, outputdir, basedir):
+    """ Write the precache manifest and the service worker for the book,
+        along with the assets that come with tex2htm
+
+        The service worker carries a digest of the manifest, so browsers
+        notice that it changed whenever any file of the book does.
+    """
+    copy_assets(ctxs, writer, outputdir, basedir)
+    manifest = json.dumps(precache_manifest(ctxs, writer, outputdir),
+                          indent=1, sort_keys=True) + '\n'
+    writer.write(os.path.join(outputdir, precache_manifest_name), manifest)
+    version = hashlib.sha256(manifest.encode('utf-8')).hexdigest()[:16]
+    template = open(basedir + os.path.sep + 'service-worker.js').read()
+    writer.write(os.path.join(outputdir, service_worker_name),
+                 template.replace("'VERSION'", "'{}'".format(version), 1))
+
+#
+# Build dependencies
+#
+dependency_manifest_name = '.tex2htm-depends.json'
+
+def record_dependency(ctx, filename):
+    """ Note that the chapter being converted reads the file filename """
+    ctx.dependencies.add(os.path.abspath(filename))
+
+def load_dependencies(filename):
+    """ The dependency manifest in filename, or an empty one
+
+        For each source file, the manifest has its chapter number, the
+        chapter_start() counters, its page, the digests of the files it
+        depends on, whether its page has undefined labels and, in 'state',
+        what converting it adds to the context, so an up-to-date chapter
+        can be skipped.
+    """
+    try:
+        with open(filename) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {'version': None, 'variants': [], 'chapters': dict()}
+
+# The parts of a context that converting a page adds to, each with a
+# function that makes an empty one
+page_state = [('label_map', dict), ('id_ordinals', lambda: defaultdict(int)),
+              ('used_ids', set), ('toc', list), ('graphics_files', set),
+              ('cited_keys', set), ('math_features', set),
+              ('figure_files', set), ('listings', dict),
+              ('dependencies', set), ('page_links', dict),
+              ('page_assets', dict),
+              ('asset_counts', lambda: defaultdict(int)),
+              ('unresolved_pages', set), ('undefined_labels', set),
+              ('unprocessed_commands', set),
+              ('unprocessed_environments', set), ('unhandled_accents', set)]
+
+def clear_page_state(ctx):
+    """ Empty the page_state of ctx, so that nothing carries over from the
+        pages it converted before
+    """
+    for (name, empty) in page_state:
+        setattr(ctx, name, empty())
+
+def chapter_snapshot(ctx):
+    """ The page_state of ctx, for chapter_state() to compare with """
+    return {name: copy.copy(getattr(ctx, name))
+            for (name, empty) in page_state}
+
+def chapter_state(ctx, snapshot, variants):
+    """ What converting a chapter added to ctx since chapter_snapshot()
+
+        variants has the variant_state() of each output variant.
+    """
+    return {'labels': {k: v for (k, v) in ctx.label_map.items()
+                       if snapshot['label_map'].get(k) != v},
+            'cited_keys': sorted(ctx.cited_keys - snapshot['cited_keys']),
+            'figure_files': sorted(ctx.figure_files
+                                   - snapshot['figure_files']),
+            'listings': sorted(set(ctx.listings) - set(snapshot['listings'])),
+            'variants': variants}
+
+def variant_state(vctx, htmlfilename, footnotes):
+    """ What converting a chapter added to the variant context vctx, whose
+        footnote counter was footnotes before the chapter
+    """
+    return {'toc': list(vctx.toc),
+            'math_features': sorted(vctx.math_features),
+            'assets': vctx.page_assets.get(htmlfilename, []),
+            'footnotes': vctx.footnote_counter - footnotes}
+
+def restore_chapter_state(ctx, ctxs, state, htmlfilename, outputdir):
+    """ Add a skipped chapter's state, from chapter_state(), to the contexts """
+    ctx.label_map.update({k: tuple(v) for (k, v) in state['labels'].items()})
+    ctx.cited_keys.update(state['cited_keys'])
+    ctx.figure_files.update(state['figure_files'])
+    for name in state['listings']:
+        with open(os.path.join(outputdir, *name.split('/'))) as fp:
+            ctx.listings[name] = fp.read()
+    for vctx in ctxs:
+        v = state['variants'][vctx.variant]
+        vctx.global_toc.extend([tuple(entry) for entry in v['toc']])
+        vctx.book_math_features.update(v['math_features'])
+        assets = [tuple(asset) for asset in v['assets']]
+        vctx.page_assets[htmlfilename] = assets
+        for asset in assets:
+            vctx.asset_counts[asset] += 1
+        vctx.footnote_counter += v['footnotes']
+        vctx.outputfiles[htmlfilename] = None
+
+def chapter_start(ctxs):
+    """ The counters that a chapter takes over from the ones before it
+
+        A chapter whose counters start elsewhere than in the last build
+        numbers things differently, so it is stale.
+    """
+    return {vctx.variant: {'footnote_counter': vctx.footnote_counter}
+            for vctx in ctxs}
+
+def chapter_outputs(ctxs, entry, outputdir):
+    """ The files written for the chapter with manifest entry entry """
+    outputs = [variant_filename(vctx, entry['page']) for vctx in ctxs]
+    return outputs + [os.path.join(outputdir, *name.split('/'))
+                      for name in entry['state']['listings']]
+
+def stale_chapters(ctx, ctxs, manifest, files, outputdir):
+    """ The source files in files whose chapters have to be converted again
+
+        That's the affected_chapters() of the files that changed, and the
+        chapters with missing outputs or with undefined labels (that
+        another chapter might now define). If the citations may have
+        changed, so are the bibliographies and the chapters that refer to
+        them. New or reordered chapters
+        renumber the ones after them, so then everything is stale. The
+        counters that chapters take over from earlier ones can only be
+        compared as the build goes, see chapter_start().
+    """
+    chapters = manifest['chapters']
+    if manifest['version'] != converter_version(ctx) \
+       or manifest['variants'] != [vctx.variant for vctx in ctxs] \
+       or any([f not in chapters or chapters[f]['chapter'] != i
+               for (i, f) in enumerate(files)]):
+        return set(files)
+    stale = set()
+    digests = dict()
+    for f in files:
+        entry = chapters[f]
+        if entry['unresolved'] or not all([os.path.isfile(o) for o in
+                                 chapter_outputs(ctxs, entry, outputdir)]):
+            stale.add(f)
+        for d in entry['depends']:
+            if d not in digests:
+                digest = file_digest(d)
+                digests[d] = digest.hex() if digest else None
+    changed = set([d for f in files for (d, digest)
+                   in chapters[f]['depends'].items() if digests[d] != digest])
+    affected = affected_chapters(chapters, changed, files)
+    if any([chapters[f]['state']['cited_keys'] for f in affected]) \
+       or any([may_cite(d) for d in changed]):
+        # Citations may have changed, and with them the entries of the
+        # bibliography and their numbers
+        bibs = bibliographies(chapters, files)
+        affected |= bibs | affected_chapters(chapters, bibs, files)
+    return stale | affected
+
+def may_cite(filename):
+    """ Whether the file filename has (or might have) citations """
+    try:
+        with open(filename) as fp:
+            return '\\cite' in fp.read()
+    except (OSError, ValueError):
+        return True
+
+def affected_chapters(chapters, filenames, files):
+    """ The source files in files whose chapters depend on filenames
+
+        The labels of a chapter only change with its source, except for
+        the citation numbers of a bibliography, which change with the
+        chapters that cite it. So the chapters that depend on an affected
+        bibliography are affected too.
+    """
+    names = set([os.path.abspath(f) for f in filenames])
+    result = set()
+    grown = True
+    while grown:
+        grown = False
+        for f in files:
+            entry = chapters.get(f)
+            if f in result or not entry or not names & set(entry['depends']):
+                continue
+            result.add(f)
+            if f in bibliographies(chapters, [f]):
+                names.add(os.path.abspath(f))
+                grown = True
+    return result
+
+def bibliographies(chapters, files):
+    """ The source files in files whose chapters were bibliographies in the
+        last build, that is, defined citation labels
+    """
+    return set([f for f in files if f in chapters and
+                any([k.startswith('cite:')
+                     for k in chapters[f]['state']['labels']])])
+
+def dependency_entry(ctx, ctxs, depends, htmlfilename, chapter, start,
+                     state):
+    """ The manifest entry for a chapter that has just been converted
+
+        Besides the files in depends, that it read, a chapter depends on
+        the sources of the pages it links to, as their labels end up in
+        its text.
+    """
+    depends = set(depends)
+    for vctx in ctxs:
+        for f in vctx.page_links.get(htmlfilename, dict()):
+            if f in ctx.sources:
+                depends.add(os.path.abspath(ctx.sources[f]))
+    return {'chapter': chapter,
+            'start': start,
+            'page': htmlfilename,
+            'depends': sorted(depends),
+            'unresolved': htmlfilename in ctx.unresolved_pages,
+            'state': state}
+
+def write_dependencies(ctx, ctxs, writer, filename, entries):
+    """ Write the dependency manifest, with the digests of the dependencies
+        as they are at the end of the build
+    """
+    digests = dict()
+    for entry in entries.values():
+        depends = dict()
+        for f in entry['depends']:
+            if f not in digests:
+                digest = file_digest(f)
+                digests[f] = digest.hex() if digest else None
+            depends[f] = digests[f]
+        entry['depends'] = depends
+    manifest = {'version': converter_version(ctx),
+                'variants': [vctx.variant for vctx in ctxs],
+                'chapters': entries}
+    writer.write(filename, json.dumps(manifest, indent=1, sort_keys=True)
+                 + '\n')
+
+#
+# Checking
+#
+def check_chapter(job):
+    """ Convert one chapter for check_files() and report what it found """
+    filename, chapter = job
+    parent = _worker_ctx
+    ctx = copy.copy(parent)
+    ctx.jobs = 1
+    ctx.outputfile = os.path.splitext(filename)[0] + '.html'
+    clear_page_state(ctx)
+    with open(filename) as fp:
+        tex = fp.read()
+    if filename.endswith('.bib'):
+        tex = bib_to_thebibliography(ctx, tex)
+    html = tex2htm(ctx, tex, chapter)
+    return {'label_map': ctx.label_map,
+            'refs': set([m.group(1) for m in crossref_rx.finditer(html)]),
+            'commands': ctx.unprocessed_commands,
+            'environments': ctx.unprocessed_environments}
+
+def source_lines(tex, rx):
+    """ The numbers of the lines of tex where rx matches outside comments """
+    lines = []
+    for m in rx.finditer(tex):
+        start = tex.rfind('\n', 0, m.start()) + 1
+        if re.search(r'(^|[^\\])%', tex[start:m.start()]):
+            continue
+        lines.append(tex.count('\n', 0, m.start()) + 1)
+    return lines
+
+def label_rxs(texlabel):
+    """ Regexes for the references to texlabel, as it may be written """
+    names = [texlabel] + texlabel.split(':', 1)[1:]
+    return [re.compile(r'[{{,]\s*{}\s*[}},]'.format(re.escape(name)))
+            for name in names]
+
+def check_chapters(ctx, filenames):
+    """ The check_chapter() results for filenames, from up to ctx.jobs
+        processes
+    """
+    global _worker_ctx
+    jobs = [(f, i) for (i, f) in enumerate(filenames)]
+    _worker_ctx = ctx
+    if ctx.jobs > 1 and len(jobs) > 1:
+        mp = multiprocessing.get_context('fork')
+        with mp.Pool(min(ctx.jobs, len(jobs))) as pool:
+            results = pool.map(check_chapter, jobs)
+    else:
+        results = [check_chapter(job) for job in jobs]
+    _worker_ctx = None
+    return results
+
+def check_files(ctx, filenames):
+    """ Look for undefined labels, unprocessed commands and defaulted
+        environments in filenames, without generating any output
+
+        The result is a sorted list of (filename, line, message) triples,
+        where line is 0 if the problem could not be located.
+    """
+    results = check_chapters(ctx, filenames)
+    label_map = dict()
+    for r in results:
+        label_map.update(r['label_map'])
+    diagnostics = []
+    for (filename, r) in zip(filenames, results):
+        with open(filename) as fp:
+            tex = fp.read()
+        problems = []
+        for texlabel in r['refs'] - set(label_map):
+            problems.append((label_rxs(texlabel),
+                             "Undefined label: {}".format(texlabel)))
+        for name in r['commands']:
+            rx = re.compile(r'\\{}(?![a-zA-Z])'.format(re.escape(name)))
+            problems.append(([rx], "Unprocessed command: \\{}".format(name)))
+        for name in r['environments']:
+            rx = re.compile(r'\\begin\s*{{{}}}'.format(re.escape(name)))
+            problems.append(([rx], "Defaulted environment: {}".format(name)))
+        for (rxs, msg) in problems:
+            lines = []
+            for rx in rxs:
+                lines = lines or source_lines(tex, rx)
+            for line in lines or [0]:
+                diagnostics.append((filename, line, msg))
+    return sorted(diagnostics)
+
+#
+# Batch conversion of fragments
+#
+def label_index(ctx, manifest, filenames):
+    """ The labels of the book made of filenames
+
+        They come from the dependency manifest of the last build if it
+        covers every file, and from checking the files otherwise.
+    """
+    chapters = manifest['chapters']
+    label_map = dict()
+    if all([f in chapters for f in filenames]):
+        for f in filenames:
+            label_map.update({k: tuple(v) for (k, v)
+                              in chapters[f]['state']['labels'].items()})
+        return label_map
+    check_mode = ctx.check_mode
+    ctx.check_mode = True
+    for r in check_chapters(ctx, filenames):
+        label_map.update(r['label_map'])
+    ctx.check_mode = check_mode
+    return label_map
+
+def convert_fragment(ctx, labels, tex, page, chapter=0):
+    """ Convert the fragment tex as if it were part of page
+
+        Nothing carries over from one fragment to the next: each one
+        starts from the labels of the book, and its own labels, ids and
+        warnings are dropped afterwards.
+    """
+    clear_page_state(ctx)
+    ctx.outputfile = page
+    ctx.label_map = dict(labels)
+    ctx.footnote_counter = 0
+    html = tex2htm(ctx, tex, chapter)
+    html = finish_figures(ctx, html, ctx.inputdir)
+    html = finish_crossrefs(ctx, page, html)
+    return {'html': html,
+            'math_features': sorted(ctx.math_features),
+            'undefined_labels': sorted(ctx.undefined_labels),
+            'unprocessed_commands': sorted(ctx.unprocessed_commands),
+            'unprocessed_environments': sorted(ctx.unprocessed_environments)}
+
+def percentile(values, q):
+    """ The q-th quantile of the sorted list values """
+    return values[int(q*(len(values)-1))] if values else 0
+
+def batch_convert(ctx, labels, page, infile, outfile):
+    """ Convert the fragments requested on infile, writing results to outfile
+
+        Each line of infile is a JSON object with the fragment in 'tex',
+        and optionally an 'id' to copy to the result, the 'page' that the
+        fragment goes on (for its links, page by default) and a 'chapter'
+        number. Each result is a line of JSON, in the order of the
+        requests, with the 'html' or an 'error'. Returns a summary of the
+        throughput and latency.
+    """
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for line in infile:
+        if not line.strip():
+            continue
+        t = time.perf_counter()
+        result = dict()
+        try:
+            request = json.loads(line)
+            result['id'] = request.get('id')
+            result.update(convert_fragment(ctx, labels, request['tex'],
+                                           request.get('page', page),
+                                           request.get('chapter', 0)))
+        except SystemExit:
+            # abort() has said why on stderr
+            errors += 1
+            result['error'] = 'Conversion aborted'
+        except Exception as e:
+            errors += 1
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        outfile.write(json.dumps(result) + '\n')
+        outfile.flush()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return ("Converted {} fragments ({} errors) in {:.2f} s, {:.1f} per second;"
+            " latency {:.1f} ms median, {:.1f} ms p95, {:.1f} ms p99,"
+            " {:.1f} ms max").format(
+                len(latencies), errors, elapsed,
+                len(latencies)/elapsed if elapsed else 0,
+                1000*percentile(latencies, 0.5),
+                1000*percentile(latencies, 0.95),
+                1000*percentile(latencies, 0.99),
+                1000*percentile(latencies, 1))
+
+#
+# Output variants
+#
+def setup_variants(ctx):
+    ctx.variants['standard'] = lambda ctx: None
+    ctx.variants['screenreader'] = setup_screenreader_variant
+    ctx.variants['static'] = setup_static_variant
+
+def setup_screenreader_variant(ctx):
+    ctx.screenreader_mode = True
+
+def setup_static_variant(ctx):
+    """ A variant that works without JavaScript
+
+        Without MathJax there is nobody to typeset the math, so we show
+        its TeX source in <code> and <pre> elements instead.
+    """
+    ctx.environment_handlers['dollar'] = process_static_inlinemath_env
+    for name in ['equation', 'equation*', 'align', 'align*', 'eqnarray*']:
+        ctx.environment_handlers[name] = process_static_displaymath_env
+    ctx.skeleton_filters.append(strip_scripts)
+
+def process_static_inlinemath_env(ctx, b, env, mode):
+    blocks = catlist(['<code class="math">'])
+    blocks.extend(process_recursively(ctx, env.content, mode | MATH))
+    blocks.append('</code>')
+    return blocks
+
+def process_static_displaymath_env(ctx, b, env, mode):
+    blocks = catlist(['<pre class="math">'])
+    blocks.extend(process_env_passthru(ctx, b, env, mode | MATH))
+    blocks.append('</pre>')
+    return blocks
+
+def strip_scripts(html):
+    """ Remove scripts, and the MathJax macro definitions, from html """
+    html = re.sub(r'<script.*?</script>\s*', '', html, 0, re.S)
+    return mathjax_macros_rx.sub('', html)
+
+def make_variant(ctx, name):
+    """ A copy of ctx that renders the output variant name
+
+        The copy shares ctx's label map and parse cache, so labels and
+        preprocessing are shared by all variants, but has its own handlers,
+        counters and output.
+    """
+    if name not in ctx.variants:
+        abort("Unknown output variant: {}".format(name))
+    vctx = copy.copy(ctx)
+    vctx.variant = name
+    vctx.suffix = '' if name == 'standard' else '-' + name
+    vctx.command_handlers = copy.copy(ctx.command_handlers)
+    vctx.environment_handlers = copy.copy(ctx.environment_handlers)
+    vctx.skeleton_filters = list(ctx.skeleton_filters)
+    vctx.id_ordinals = copy.copy(ctx.id_ordinals)
+    vctx.used_ids = set(ctx.used_ids)
+    vctx.undefined_labels = set()
+    vctx.unprocessed_commands = set()
+    vctx.unprocessed_environments = set()
+    vctx.graphics_files = set()
+    vctx.math_features = set()
+    vctx.book_math_features = set()
+    vctx.global_toc = []
+    vctx.toc = []
+    vctx.page_links = dict()
+    vctx.page_assets = dict()
+    vctx.asset_counts = defaultdict(int)
+    vctx.outputfiles = dict()
+    ctx.variants[name](vctx)
+    return vctx
+
+def variant_filename(ctx, filename):
+    """ The name of ctx's variant of the output file filename """
+    base, ext = os.path.splitext(filename)
+    return base + ctx.suffix + ext
+
+#
+# Streaming mode, for very large single-file documents
+#
+section_start_rx = re.compile(r'\s*\\(chapter|section)\*?(?![a-zA-Z])')
+section_env_rx = re.compile(r'\\(begin|end)\s*{[^}]*}')
+document_line_rx = re.compile(r'\s*\\(begin|end)\s*{document}\s*$')
+
+def read_sections(filename, split_document=True):
+    """ Read filename incrementally, one \\chapter or \\section at a time
+
+        This is a light line-based scan: a piece ends just before any line
+        that starts with a \\chapter or \\section command, or before the
+        blank lines in front of it, unless that line is inside an
+        environment. The pieces are joined by the newline that tex2htm()
+        drops from the end of each of them.
+
+        If split_document, the lines \\begin{document} and \\end{document}
+        are pieces of their own, so that process_stream() can open and
+        close the document around the pieces in between.
+    """
+    lines = []
+    depth = 0
+    with open(filename, "r") as fp:
+        for line in fp:
+            if split_document and depth == 0 and document_line_rx.match(line):
+                if lines:
+                    yield "".join(lines)
+                    lines = []
+                yield line.strip()
+                continue
+            if depth == 0 and section_start_rx.match(line):
+                i = len(lines)
+                while i > 0 and not lines[i-1].strip():
+                    i -= 1
+                if i > 0:
+                    yield "".join(lines[:i])
+                    lines = lines[i:]
+            lines.append(line)
+            code = re.sub(r'(^|[^\\])%.*', r'\1', line)
+            for m in section_env_rx.finditer(code):
+                depth += 1 if m.group(1) == 'begin' else -1
+    if lines:
+        yield "".join(lines)
+
+class spool(object):
+    """ A sequence of HTML pieces that is kept in a temporary file """
+    def __init__(self):
+        self.fp = tempfile.TemporaryFile()
+        self.sizes = []
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        self.fp.write(data)
+        self.sizes.append(len(data))
+
+    def __iter__(self):
+        self.fp.seek(0)
+        for size in self.sizes:
+            yield self.fp.read(size).decode('utf-8')
+
+def process_stream(ctxs, filename, dirname, chapter):
+    """ Like process_file(), but reads and translates filename piece by piece
+
+        Only one section is held in memory at a time: each piece is read
+        once and translated for every context in ctxs, whose variants
+        share its preprocessing, and the translated pieces go to a spool
+        for each context instead of being joined into one string.
+    """
+    # The document environment is opened and closed here, as
+    # process_env_default() would, unless someone handles it differently
+    split = all([ctx.environment_handlers['document'] is process_env_default
+                 for ctx in ctxs])
+    streams = []
+    for ctx in ctxs:
+        streams.append({'ctx': ctx, 'counters': label_counters(chapter),
+                        'output': spool(), 'sep': '', 'held': '',
+                        'offset': 0})
+    for tex in read_sections(filename, split):
+        for s in streams:
+            stream_piece(s, tex, split, dirname, chapter)
+        if ctxs[0].parse_cache:
+            ctxs[0].parse_cache.clear()
+    for s in streams:
+        finish_stream_piece(s, postprocess(s['held']), dirname)
+    return [s['output'] for s in streams]
+
+def stream_piece(s, tex, split, dirname, chapter):
+    """ Translate the piece tex for the stream s of process_stream(), which
+        has split the document environment off if split
+
+        The text of the stream is postprocessed up to the last place that
+        none of the rules of postprocess() can match across, and the rest
+        is held back for the next piece.
+    """
+    ctx = s['ctx']
+    m = document_line_rx.match(tex) if split else None
+    if m and m.group(1) == 'begin':
+        ctx.unprocessed_environments.add('document')
+        htm = '<div class="document">'
+    elif m:
+        htm = '</div><!-- document -->'
+    else:
+        htm = tex2htm(ctx, tex, chapter, s['counters'], finish=False)
+    htm = s['held'] + s['sep'] + htm
+    s['sep'] = '\n'
+    i = len(htm)
+    while i > 0 and '\\' in htm[i-1:i+1]:
+        i -= 1
+    s['held'] = htm[i:]
+    finish_stream_piece(s, postprocess(htm[:i]), dirname)
+
+def finish_stream_piece(s, htm, dirname):
+    """ Add the postprocessed text htm to the output of the stream s """
+    ctx = s['ctx']
+    with stage(ctx, 'graphics'):
+        generate_graphics_files(ctx, ctx.graphics_files, dirname)
+    ctx.graphics_files.clear()
+    with stage(ctx, 'figures'):
+        s['output'].append(finish_figures(ctx, htm, dirname, s['offset']))
+    s['offset'] += len(htm)
+
+class output_writer(object):
+    """ Writes output files, leaving files whose content is unchanged alone
+
+        Changed files are written to a temporary file that is then renamed
+        over the old one, so nobody ever sees a half-written file.
+    """
+    def __init__(self):
+        self.written = 0
+        self.written_bytes = 0
+        self.unchanged = 0
+        self.unchanged_bytes = 0
+        # The SHA-256 digest of every file written or left alone
+        self.digests = dict()
+
+    def write(self, filename, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+        self.digests[filename] = digest
+        if file_digest(filename) == digest:
+            self.unchanged += 1
+            self.unchanged_bytes += len(data)
+            return False
+        return self.write_chunks(filename, [text])
+
+    def write_chunks(self, filename, chunks):
+        """ Like write(), for text that is given as a sequence of pieces """
+        dirname = os.path.dirname(filename) or '.'
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tex2htm-')
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    data = chunk.encode('utf-8')
+                    digest.update(data)
+                    size += len(data)
+                    fp.write(data)
+            self.digests[filename] = digest.digest()
+            if file_digest(filename) == digest.digest():
+                os.unlink(tmpname)
+                self.unchanged += 1
+                self.unchanged_bytes += size
+                return False
+            print("Writing to {}".format(filename))
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpname, 0o666 & ~umask)
+            os.replace(tmpname, filename)
+        except:
+            os.unlink(tmpname)
+            raise
+        self.written += 1
+        self.written_bytes += size
+        return True
+
+    def keep(self, filename):
+        """ Count filename, which is up to date, as an unchanged file """
+        self.digests[filename] = file_digest(filename)
+        self.unchanged += 1
+        self.unchanged_bytes += os.path.getsize(filename)
+
+    def summary(self):
+        return "Wrote {} files ({} bytes), {} unchanged ({} bytes)".format(
+            self.written, self.written_bytes, self.unchanged,
+            self.unchanged_bytes)
+
+def file_digest(filename):
+    """ The SHA-256 digest of a file, or None if it can't be read """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 16), b''):
+                digest.update(block)
+        return digest.digest()
+    except OSError:
+        return None
 
 def relative_path(fn1, fn2):
     dir1 = os.path.dirname(fn1)
@@ -893,64 +3021,296 @@ def relative_path(fn1, fn2):
               + os.path.basename(dir2)
 
 if __name__ == "__main__":
+    # Extensions import us as tex2htm, and should get this module, not a copy
+    sys.modules.setdefault('tex2htm', sys.modules[__name__])
+
     # Setup a few things
     ctx = context()
     setup_environment_handlers(ctx)
     setup_command_handlers(ctx)
-    ods.setup_environment_handlers(ctx) # TODO: ods specific
-    ods.setup_command_handlers(ctx) # TODO: ods specific
+
+    parser = argparse.ArgumentParser(description='Convert LaTeX to HTML')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes used to convert the '
+                             'sections of each chapter')
+    parser.add_argument('--stream', action='store_true',
+                        help='read and convert each file one section at a '
+                             'time, for very large files')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep preprocessed documents in DIR so later '
+                             'runs can skip preprocessing')
+    parser.add_argument('--variant', action='append', default=[],
+                        help='output variant to render: standard, '
+                             'screenreader or static (may be repeated)')
+    parser.add_argument('--screenreader', action='store_true',
+                        help='same as --variant screenreader')
+    parser.add_argument('-p', '--plugin', action='append', default=[],
+                        help='load an extension module, like ods')
+    parser.add_argument('--import-report', action='store_true',
+                        help='report how long extensions and their '
+                             'dependencies took to import')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a timeline of the build to FILE, in '
+                             'Chrome trace event format')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='report the peak and retained memory of each '
+                             'stage and chapter')
+    parser.add_argument('--max-memory', metavar='SIZE', type=parse_size,
+                        help='fail if any stage allocates more than SIZE '
+                             '(like 512M) at a time')
+    parser.add_argument('--share-listings', action='store_true',
+                        help='write each long code listing once, to a file '
+                             'that pages load when it is scrolled into view')
+    parser.add_argument('--offline', action='store_true',
+                        help='write a precache manifest and a service worker '
+                             'that keeps the book for offline reading')
+    parser.add_argument('--changed', action='store_true',
+                        help='only convert the chapters affected by files '
+                             'changed since the last build')
+    parser.add_argument('--dependents', metavar='FILE', action='append',
+                        default=[],
+                        help='list the chapters that depend on FILE, '
+                             'according to the last build, and exit')
+    parser.add_argument('--check', action='store_true',
+                        help='only report undefined labels, unprocessed '
+                             'commands and defaulted environments, without '
+                             'rendering or writing anything')
+    parser.add_argument('--batch', action='store_true',
+                        help='convert the LaTeX fragments of the JSON lines '
+                             'on stdin, with the labels of files, and write '
+                             'JSON lines to stdout')
+    parser.add_argument('files', nargs='+',
+                        help='LaTeX files (and .bbl or .bib files) to convert')
+    args = parser.parse_args()
+    ctx.jobs = args.jobs
+    ctx.cachedir = args.cache
+    ctx.share_listings = args.share_listings
+    if args.offline:
+        ctx.skeleton_filters.append(register_service_worker)
+    if args.trace:
+        ctx.tracer = tracer()
+    if args.memory_report or args.max_memory:
+        ctx.memory = memory_meter(args.max_memory)
+    setup_variants(ctx)
+    for name in args.plugin:
+        load_plugin(ctx, name)
+    variants = args.variant or ['standard']
+    if args.screenreader and 'screenreader' not in variants:
+        variants.append('screenreader')
+    if len(variants) > 1:
+        # Variants share one preprocessing pass per input file
+        ctx.parse_cache = dict()
 
     # TODO: Use a better default, or specify on command line
-    outputdir = os.path.dirname(sys.argv[1])
+    outputdir = os.path.dirname(args.files[0])
+    ctx.inputdir = outputdir
+    # The table of contents goes in the index, and in a fragment that the
+    # other pages load when asked to
+    indexfile = outputdir + os.path.sep + 'index.html'
+    tocfile = outputdir + os.path.sep + 'toc.html'
+    # What each chapter depended on in the last build
+    depsfile = os.path.join(outputdir, dependency_manifest_name)
+    manifest = load_dependencies(depsfile)
+    if args.dependents:
+        dependents = affected_chapters(manifest['chapters'],
+                                       args.dependents, args.files)
+        for f in args.files:
+            if f in dependents:
+                print(f)
+        sys.exit(0)
+    if args.check:
+        ctx.check_mode = True
+        diagnostics = check_files(ctx, args.files)
+        for (filename, line, msg) in diagnostics:
+            print("{}:{}: {}".format(filename, line, msg))
+        print("{} problems in {} files".format(len(diagnostics),
+                                               len(args.files)))
+        sys.exit(1 if diagnostics else 0)
+    if args.batch:
+        bctx = make_variant(ctx, variants[0])
+        bctx.jobs = 1
+        labels = label_index(bctx, manifest, args.files)
+        summary = batch_convert(bctx, labels, indexfile, sys.stdin, sys.stdout)
+        sys.stderr.write(summary + '\n')
+        sys.exit(0)
 
     # Read common skeleton
     basedir = os.path.dirname(sys.argv[0])
     filename = basedir + os.path.sep + 'skeleton.htm'
-    (head, tail) = re.split('CONTENT', open(filename).read())
+    skeleton = open(filename).read()
 
-    ctx.outputfiles = dict()
-    ctx.screenreader_mode = False
+    ctxs = [make_variant(ctx, name) for name in variants]
+    for vctx in ctxs:
+        html = skeleton
+        for f in vctx.skeleton_filters:
+            html = f(html)
+        (vctx.head, vctx.tail) = re.split('CONTENT', html)
+    writer = output_writer()
 
     # Process all the input files
+    stale = set(args.files)
+    if args.changed:
+        stale = stale_chapters(ctx, ctxs, manifest, args.files, outputdir)
+    chapters = dict()
     chapter = 0
-    for filename in sys.argv[1:]:
+    for filename in args.files:
         texfilename = filename
         dirname = os.path.dirname(texfilename)
         base, ext = os.path.splitext(texfilename)
         htmlfilename = base + '.html'
-        ctx.outputfile = htmlfilename
+        ctx.sources[htmlfilename] = texfilename
+        start = chapter_start(ctxs)
+        if texfilename not in stale and \
+           manifest['chapters'][texfilename].get('start') != start:
+            # An earlier chapter changed how many things it numbered
+            stale.add(texfilename)
+        if texfilename not in stale:
+            print("Up to date: {}".format(texfilename))
+            entry = manifest['chapters'][texfilename]
+            restore_chapter_state(ctx, ctxs, entry['state'], htmlfilename,
+                                  outputdir)
+            if entry['state']['cited_keys']:
+                ctx.citing_sources.add(texfilename)
+            chapters[texfilename] = dict(entry,
+                                         depends=sorted(entry['depends']))
+            chapter += 1
+            continue
+        ctx.dependencies.clear()
+        record_dependency(ctx, texfilename)
+        snapshot = chapter_snapshot(ctx)
+        variants = dict()
         print("Reading from {}".format(texfilename))
-        tex = open(texfilename, "r").read()
-        content = process_file(ctx, tex, dirname, chapter)
-
-        headx = re.sub('TITLE', ctx.title, head)
-        headx = re.sub('TOC', ''.join(ctx.toc), headx)
-        ctx.global_toc.extend(ctx.toc)
-        ctx.toc.__init__()
-
-        ctx.outputfiles[htmlfilename] = "".join([headx, content, tail])
-
+        stream = args.stream and ext != '.bib'
+        with stage(ctx, 'read', file=texfilename):
+            if not stream:
+                tex = open(texfilename, "r").read()
+            if ext == '.bib':
+                tex = bib_to_thebibliography(ctx, tex)
+        if ctx.parse_cache:
+            ctx.parse_cache.clear()
+        footnotes = dict()
+        for vctx in ctxs:
+            vctx.outputfile = htmlfilename
+            footnotes[vctx.variant] = vctx.footnote_counter
+        if stream:
+            # All variants take their turn at each piece, which is read once
+            with stage(ctx, 'chapter', file=texfilename):
+                contents = process_stream(ctxs, texfilename, dirname,
+                                          chapter)
+        for (i, vctx) in enumerate(ctxs):
+            if stream:
+                content = contents[i]
+            else:
+                with stage(vctx, 'chapter', file=texfilename,
+                           variant=vctx.variant):
+                    content = process_file(vctx, tex, dirname, chapter)
+
+            headx = re.sub('TITLE', vctx.title, vctx.head)
+            headx = headx.replace('TOC', toc_loader(vctx, htmlfilename,
+                                                    indexfile, tocfile), 1)
+            headx = configure_mathjax(vctx, headx, vctx.math_features)
+            vctx.book_math_features |= vctx.math_features
+            record_assets(vctx, htmlfilename, headx)
+            variants[vctx.variant] = variant_state(
+                vctx, htmlfilename, footnotes[vctx.variant])
+            vctx.math_features = set()
+            vctx.global_toc.extend(vctx.toc)
+            vctx.toc = []
+
+            if stream:
+                vctx.outputfiles[htmlfilename] = itertools.chain(
+                    [headx], content, [vctx.tail])
+            else:
+                vctx.outputfiles[htmlfilename] = "".join([headx, content,
+                                                          vctx.tail])
+
+        state = chapter_state(ctx, snapshot, variants)
+        if state['cited_keys']:
+            ctx.citing_sources.add(texfilename)
+        entry = manifest['chapters'].get(texfilename)
+        if not entry or entry['state']['cited_keys'] != state['cited_keys']:
+            # The bibliography renders the entries that are cited, and
+            # only depends on the chapters that cited some in the last
+            # build; stale_chapters() catches the usual \cite commands
+            bibs = bibliographies(manifest['chapters'], args.files)
+            stale |= bibs | affected_chapters(manifest['chapters'], bibs,
+                                              args.files)
+        chapters[texfilename] = (set(ctx.dependencies), htmlfilename, chapter,
+                                 start, state)
         chapter += 1
 
-    for htmlfilename in ctx.outputfiles:
-        ctx.outputfiles[htmlfilename] = finish_crossrefs(htmlfilename,
-                                                     ctx.label_map,
-                                                     ctx.outputfiles[htmlfilename])
-        print("Writing to {}".format(htmlfilename))
-        of = open(htmlfilename, 'w')
-        of.write(ctx.outputfiles[htmlfilename])
-        of.close()
-
-    # Create global table of contents
-    title = 'Open Data Structures'
-    headx = re.sub('TITLE', title, head)
-    tocfile = outputdir + os.path.sep + 'index.html'
-    tochtml = finish_crossrefs(tocfile, ctx.label_map, "".join(ctx.global_toc))
-    headx = re.sub('TOC', tochtml, headx)
-    fp = open(tocfile, 'w')
-    fp.write(headx)
-    fp.write(tail)
-    fp.close()
+    # Listings are the same in all variants, and shared by all pages
+    if ctx.listings:
+        with stage(ctx, 'listings', listings=len(ctx.listings)):
+            os.makedirs(os.path.join(outputdir, listing_dir), exist_ok=True)
+            for name in sorted(ctx.listings):
+                writer.write(os.path.join(outputdir, *name.split('/')),
+                             ctx.listings[name])
+
+    for vctx in ctxs:
+        pages = list(vctx.outputfiles)
+        for (i, htmlfilename) in enumerate(pages):
+            outputfile = variant_filename(vctx, htmlfilename)
+            nextfile = pages[i+1] if i+1 < len(pages) else None
+            if vctx.outputfiles[htmlfilename] is None:
+                # An up-to-date page, see stale_chapters()
+                writer.keep(outputfile)
+                continue
+            if not isinstance(vctx.outputfiles[htmlfilename], str):
+                # A spooled page, which we finish one piece at a time. Its
+                # head goes out before its links are known, so it only
+                # gets a hint for the next chapter.
+                with stage(vctx, 'finish_crossrefs and write',
+                           file=outputfile):
+                    pieces = (finish_crossrefs(vctx, htmlfilename, piece)
+                              for piece in vctx.outputfiles[htmlfilename])
+                    headx = add_link_hints(vctx, htmlfilename, nextfile,
+                                           next(pieces))
+                    writer.write_chunks(outputfile,
+                                        itertools.chain([headx], pieces))
+                continue
+            with stage(vctx, 'finish_crossrefs', file=outputfile):
+                html = finish_crossrefs(vctx, htmlfilename,
+                                        vctx.outputfiles[htmlfilename])
+                vctx.outputfiles[htmlfilename] = add_link_hints(vctx,
+                    htmlfilename, nextfile, html)
+            with stage(vctx, 'write', file=outputfile):
+                writer.write(outputfile, vctx.outputfiles[htmlfilename])
+
+        # Create global table of contents
+        with stage(vctx, 'index', variant=vctx.variant):
+            title = 'Open Data Structures'
+            headx = re.sub('TITLE', title, vctx.head)
+            tochtml = finish_crossrefs(vctx, indexfile,
+                                       toc_html(vctx.global_toc))
+            writer.write(variant_filename(vctx, tocfile), tochtml)
+            headx = headx.replace('TOC', tochtml, 1)
+            # Section titles can have math in them
+            features = vctx.book_math_features if '\\(' in tochtml else set()
+            headx = configure_mathjax(vctx, headx, features)
+            record_assets(vctx, indexfile, headx)
+            headx = add_link_hints(vctx, indexfile,
+                                   pages[0] if pages else None, headx)
+            writer.write(variant_filename(vctx, indexfile), headx + vctx.tail)
+    if args.offline:
+        with stage(ctx, 'offline'):
+            write_offline_bundle(ctxs, writer, outputdir, basedir)
+    for (f, entry) in chapters.items():
+        if isinstance(entry, tuple):
+            (depends, htmlfilename, chapter, start, state) = entry
+            chapters[f] = dependency_entry(ctx, ctxs, depends, htmlfilename,
+                                           chapter, start, state)
+    write_dependencies(ctx, ctxs, writer, depsfile, chapters)
+    print(writer.summary())
+    if ctx.tracer:
+        ctx.tracer.write(args.trace)
+    if args.memory_report:
+        ctx.memory.report()
+
+    for vctx in ctxs:
+        ctx.undefined_labels |= vctx.undefined_labels
+        ctx.unprocessed_commands |= vctx.unprocessed_commands
+        ctx.unprocessed_environments |= vctx.unprocessed_environments
 
     # Print warnings
     if ctx.undefined_labels:
@@ -962,3 +3322,12 @@ if __name__ == "__main__":
     if ctx.unprocessed_environments:
         environments = ", ".join(sorted(ctx.unprocessed_environments))
         warn("Defaulted environments: {}".format(environments))
+    if ctx.unhandled_accents:
+        accents = ", ".join(sorted(ctx.unhandled_accents))
+        warn("Unhandled accents: {}".format(accents))
+
+    if args.import_report:
+        for name in ctx.import_times:
+            print("Imported {} in {:.1f} ms".format(name,
+                                                   1000*ctx.import_times[name]))
+        print("{} modules loaded in total".format(len(sys.modules)))